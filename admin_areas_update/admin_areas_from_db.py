@@ -1,46 +1,16 @@
-import numpy as np
+import sys
 import pandas as pd
 import geopandas as gpd
 import sqlalchemy as sal
 from shapely import wkb
+from pathlib import Path
 import admin_config as cfg
 
-def createGrid(degrees=1.0):
-    """
-    Create a Geopandas dataframe fishnet grid
-
-    Params:
-        degrees: Size of grid
-    
-    Return:
-        Dataframe containing grid.
-    """
-    ulx, uly, lrx, lry = -180, 90, 180, -90
-
-    # resolution 1 degree grid
-    xres = degrees
-    yres = -degrees
-
-    # half the resolution
-    dx = xres / 2
-    dy = yres / 2
-
-    # center coordinates
-    xx, yy = np.meshgrid(
-        np.arange(ulx + dx, lrx + dx, xres),
-        np.arange(uly + dy, lry + dy, yres),
-    )
-
-    wkts = []
-    for x, y in zip(xx.ravel(), yy.ravel()):
-        poly_wkt = f"POLYGON (({x - dx} {y - dy}, {x + dx} {y - dy}, {x + dx} {y + dy}, {x - dx} {y + dy}, {x - dx} {y - dy}))"
-        wkts.append(poly_wkt)
-
-    s = gpd.GeoSeries.from_wkt(wkts)
-    df = gpd.GeoDataFrame(geometry=s, crs="EPSG:4326")
-    df["grid"] = df.index
-    
-    return df
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import dicing
+from common.geometry_repair import repair_invalid, print_report
+from common.diced_output import DicedWriter
+from common.dice_cache import DiceCache
 
 def convertWKBforGPD(dataframe, columnName):
     """
@@ -64,13 +34,16 @@ def convertWKBforGPD(dataframe, columnName):
     
     return df
 
-def main(connection, current_table):
+def main(connection, current_table, workers=1, out_format="tsv", cache_path=None):
     """
     Main function to split a list of polygons into a grid, then saves to CSV
 
     Params:
         connection: SQLAlchemy connection to db
         current_table: String name of table
+        workers: Number of dicing processes
+        out_format: "tsv" for hex wkb text, "parquet" for GeoParquet
+        cache_path: Optional SQLite file caching diced pieces between runs
     """
     print(f'working on {current_table}')
 
@@ -83,20 +56,26 @@ def main(connection, current_table):
     print("converting to geopandas")
     gdf = convertWKBforGPD(df, 'geom')
     gdf.drop(columns=['geom'], inplace=True)
-    gdf['geometry'] = gdf['geometry'].buffer(0)
+
+    print("repairing invalid geometries")
+    gdf['geometry'], report = repair_invalid(gdf['geometry'])
+    print_report(report)
     #print(gdf.head())
 
-    print("creating in memory grid")
-    grid = createGrid(degrees=1)
+    cache = None
+    if cache_path:
+        cache = DiceCache(cache_path, max_bytes=getattr(cfg, "dice_cache_max_bytes", 2 * 1024**3))
 
-    print("intersection with grid")
-    gdf_intersection = gpd.overlay(gdf, grid, how="intersection", keep_geom_type=True, make_valid=True)
+    print("dicing with grid")
+    gdf_intersection = dicing.dice(gdf, degrees=1, cache_dir=getattr(cfg, "grid_cache_dir", None), workers=workers, repair=False, cache=cache)
 
-    print("save geometry as wkb")
-    gdf_intersection["geom"] = gdf_intersection.geometry.apply(wkb.dumps, hex=True)  # add in wkb
+    if cache is not None:
+        cache.report()
+        cache.close()
 
-    print("saving to csv")
-    gdf_intersection[["list_id", "location_id", "geom"]].to_csv(cfg.admin_areas_out_path, sep="\t", index=False)
+    print(f"saving to {out_format}")
+    with DicedWriter(cfg.admin_areas_out_path, fmt=out_format) as writer:
+        writer.write(gdf_intersection, ["list_id", "location_id"])
 
     return
 
@@ -108,6 +87,9 @@ if __name__ == "__main__":
     print("connected")
 
     # administrative areas only
-    main(conn, "list-administrativeAreas")
+    main(conn, "list-administrativeAreas",
+         workers=getattr(cfg, "dice_workers", 1),
+         out_format=getattr(cfg, "diced_format", "tsv"),
+         cache_path=getattr(cfg, "dice_cache_path", None))
 
     print("done")
\ No newline at end of file
@@ -1,30 +1,41 @@
+import sys
 import pandas as pd
 import sqlalchemy as sal
+from pathlib import Path
 import admin_config as cfg
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.bulk_load import bulk_load, build_indexes, dbapi_connection, staged_load, swap_table
+from common.merge_load import merge_load
+from common.cleaning import clean_for_schema
+from common.results_reader import read_results
+
 # Data cleaning
-def cleanData(new_dataframe, location_id_dataframe, column_name_dataframe):
+def cleanData(new_dataframe, location_id_dataframe, column_names):
     """
     Prepares the data for storage in DB
 
     Params:
         new_dataframe: Input data
-        location_id_dataframe: Dataframe containing location_id values
-        column_name_dataframe: Dataframe containing target column names
+        location_id_dataframe: Dataframe containing location_id values, None
+            when extra locations are removed on the server, see reconcileLocations
+        column_names: Target column names, see tableColumns
 
     Return:
         Dataframe with all data consolidated
     """
-    # Find extra location_ids
-    old_locs = set(location_id_dataframe['location_id'])
-    new_locs = set(new_dataframe['location_id'])
-    extra_locs = new_locs - old_locs
+    output_dataframe = new_dataframe
+    if location_id_dataframe is not None:
+        # Find extra location_ids
+        old_locs = set(location_id_dataframe['location_id'])
+        new_locs = set(new_dataframe['location_id'])
+        extra_locs = new_locs - old_locs
 
-    # Remove extra rows
-    output_dataframe = new_dataframe[~new_dataframe['location_id'].isin(extra_locs)]
+        # Remove extra rows
+        output_dataframe = new_dataframe[~new_dataframe['location_id'].isin(extra_locs)]
 
     # Drop extra cols
-    output_dataframe = output_dataframe.drop(['list_id', 'location_error'], axis=1)
+    output_dataframe = output_dataframe.drop(['list_id', 'location_error'], axis=1, errors='ignore')
 
     # Rename cols
     output_dataframe = output_dataframe.rename({'status_code':'location_status_id'}, axis=1)
@@ -33,7 +44,7 @@ def cleanData(new_dataframe, location_id_dataframe, column_name_dataframe):
     output_dataframe.insert(0, 'id', output_dataframe.index)
 
     # Get missing cols
-    old_cols = set(column_name_dataframe.columns.values.tolist())
+    old_cols = set(column_names)
     new_cols = set(output_dataframe.columns.values.tolist())
     missing_cols = old_cols - new_cols
 
@@ -46,40 +57,59 @@ def cleanData(new_dataframe, location_id_dataframe, column_name_dataframe):
     
     return output_dataframe
 
-def boolConvert(clean_dataframe):
+def tableColumns(connection, table_name):
     """
-    Replaces (bool) True with (str) 'true' 
+    Reads a table's column names from INFORMATION_SCHEMA, no data is read
 
     Params:
-        clean_dataframe: DF with bool values
-    
-    Returns:
-        DF with bools converted to string
+        connection: SQLAlchemy connection
+        table_name: Table in dbo
+
+    Return:
+        List of column names in table order
     """
-    mask = clean_dataframe.applymap(type) != bool
-    d = {True: 'true', False: 'false'}
-    clean_dataframe = clean_dataframe.where(mask, clean_dataframe.replace(d))
+    col_sql = ("SELECT [COLUMN_NAME] FROM INFORMATION_SCHEMA.COLUMNS "
+               f"WHERE [TABLE_SCHEMA] = 'dbo' AND [TABLE_NAME] = '{table_name}' "
+               "ORDER BY [ORDINAL_POSITION]")
 
-    return clean_dataframe
+    return pd.read_sql(col_sql, connection)['COLUMN_NAME'].tolist()
 
-def cleanNvarchar(cleaned_dataframe):
+def reconcileLocations(connection, loaded_table, current_table):
     """
-    Replace empty nvarchar with {}
-    
+    Removes loaded rows whose location is not in the current table, in SQL
+
+    Both tables are compared with set-based joins on the server, so the
+    location_id list never has to be pulled into pandas.
+
     Params:
-        cleaned_dataframe: DF with empty values
-    
-    Returns:
-        DF with {} instead of null strings
+        connection: SQLAlchemy connection
+        loaded_table: Table in dbo holding the new results
+        current_table: Table in dbo whose locations are kept
+
+    Return:
+        Tuple of (extra rows deleted, current locations missing from the results)
     """
-    # Create a list of columns that contain NVARCHAR datatype
-    nvarchar_cols = [k for k, v in cfg.admin_areas_db_schema.items() if 'NVARCHAR' in str(v)]
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+
+    cursor.execute(f"""
+        DELETE n FROM [dbo].[{loaded_table}] AS n
+        WHERE NOT EXISTS (
+            SELECT 1 FROM [dbo].[{current_table}] AS c WHERE c.[location_id] = n.[location_id]
+        )""")
+    extra = cursor.rowcount
 
-    # Replace None values with {} in NVARCHAR columns
-    for column in nvarchar_cols:
-        cleaned_dataframe[column].fillna(r'{}', inplace=True)
+    cursor.execute(f"""
+        SELECT COUNT(*) FROM [dbo].[{current_table}] AS c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM [dbo].[{loaded_table}] AS n WHERE n.[location_id] = c.[location_id]
+        )""")
+    missing = cursor.fetchone()[0]
+    raw.commit()
 
-    return cleaned_dataframe
+    print(f"removed {extra} extra locations, {missing} locations of {current_table} have no results")
+
+    return extra, missing
 
 def main(connection, current_table, in_file):
     """
@@ -93,36 +123,76 @@ def main(connection, current_table, in_file):
     print(f'working on {current_table}')
 
     # Get original col names
-    col_sql = f"SELECT TOP (1) * FROM dbo.[{current_table}]"
-    col_df = pd.read_sql(col_sql, connection)
-    print("loaded column name dataframe")
+    col_names = tableColumns(connection, current_table)
+    print("loaded column names")
+
+    # Extra locations are removed on the server after loading, unless merging
+    reconcile = (getattr(cfg, 'reconcile_on_server', False)
+                 and getattr(cfg, 'load_mode', 'replace') != 'merge')
 
-    # Get original location_ids
-    loc_sql = f"SELECT [location_id] FROM dbo.[{current_table}]"
-    loc_df = pd.read_sql(loc_sql, connection)
-    print("loaded location_id dataframe")
+    loc_df = None
+    if not reconcile:
+        # Get original location_ids
+        loc_sql = f"SELECT [location_id] FROM dbo.[{current_table}]"
+        loc_df = pd.read_sql(loc_sql, connection)
+        print("loaded location_id dataframe")
 
     # Read new data from .tsv
-    new_df = pd.read_csv(in_file, sep='\t')
+    new_df = read_results(in_file,
+                          columns=list(cfg.admin_areas_db_schema) + ['status_code'],
+                          schema=cfg.admin_areas_db_schema,
+                          rename={'status_code': 'location_status_id'}
+                          )
     print("loaded new data dataframe")
 
     # Clean new_df
-    clean_df = cleanData(new_df, loc_df, col_df)
+    clean_df = cleanData(new_df, loc_df, col_names)
     print("cleanData() complete")
 
-    # Replace boolean values with string
-    clean_df = boolConvert(clean_df)
-    print("boolConvert() complete")
-
-    # Replaces None values with {} in NVARCHAR data type cols
-    clean_df = cleanNvarchar(clean_df)
-    print("cleanNvarchar() complete")
+    # Bools to text and {} for empty NVARCHAR, column by column
+    clean_df = clean_for_schema(clean_df, cfg.admin_areas_db_schema)
+    print("clean_for_schema() complete")
 
     print("saving dataframe to database")
-    clean_df.to_sql(f'{current_table}_new',
-                    conn, index=False,
-                    if_exists='replace',
-                    dtype=cfg.admin_areas_db_schema
+    if getattr(cfg, 'load_mode', 'replace') == 'merge':
+        # incremental refresh of the live table, only changed rows are written
+        merge_load(connection,
+                   current_table,
+                   clean_df,
+                   cfg.admin_areas_db_schema,
+                   batch_size=getattr(cfg, 'load_batch_size', 20000),
+                   workers=getattr(cfg, 'load_workers', 1)
+                   )
+    elif reconcile:
+        # load as a heap, reconcile against the live table, then index
+        swap = getattr(cfg, 'swap_into_live', False)
+        load_name = f'{current_table}_staging' if swap else f'{current_table}_new'
+        bulk_load(connection,
+                  load_name,
+                  clean_df,
+                  cfg.admin_areas_db_schema,
+                  batch_size=getattr(cfg, 'load_batch_size', 20000),
+                  workers=getattr(cfg, 'load_workers', 1)
+                  )
+        reconcileLocations(connection, load_name, current_table)
+        build_indexes(connection,
+                      load_name,
+                      index_name=current_table if swap else load_name,
+                      columnstore=getattr(cfg, 'columnstore', False)
+                      )
+        if swap:
+            swap_table(connection, load_name, current_table)
+    else:
+        # swap straight into the live table, or leave _new for validation
+        swap = getattr(cfg, 'swap_into_live', False)
+        staged_load(connection,
+                    current_table if swap else f'{current_table}_new',
+                    clean_df,
+                    cfg.admin_areas_db_schema,
+                    swap=swap,
+                    columnstore=getattr(cfg, 'columnstore', False),
+                    batch_size=getattr(cfg, 'load_batch_size', 20000),
+                    workers=getattr(cfg, 'load_workers', 1)
                     )
 
     return
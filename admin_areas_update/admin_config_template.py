@@ -7,6 +7,37 @@ sal_string = ""
 # Directory to store data exported from DB
 admin_areas_out_path = os.path.join("data", f"diced_admin_areas")
 
+# Optional directory to persist dicing grids between runs
+grid_cache_dir = None
+
+# Number of processes used to dice geometries
+dice_workers = 1
+
+# Diced output format, "tsv" (hex wkb) or "parquet" (GeoParquet)
+diced_format = "tsv"
+
+# Optional SQLite file caching diced pieces between runs, and its size cap
+dice_cache_path = None
+dice_cache_max_bytes = 2 * 1024**3
+
+# Rows per batch when loading analysis results into the database
+load_batch_size = 20000
+
+# Concurrent connections when loading, each loads its own location_id range
+load_workers = 1
+
+# Swap the loaded table into the live name instead of leaving a _new table,
+# and optionally index it with a clustered columnstore
+swap_into_live = False
+columnstore = False
+
+# "replace" reloads the whole table, "merge" upserts only rows whose hash changed
+load_mode = "replace"
+
+# Remove locations missing from the live table with SQL after loading,
+# instead of pulling every location_id into pandas (replace mode only)
+reconcile_on_server = False
+
 # Path to processed data
 admin_analysis_data = r""
 
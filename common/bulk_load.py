@@ -0,0 +1,533 @@
+import time
+import pyodbc
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy as sal
+from sqlalchemy.dialects import mssql
+
+# Errors caused by the rows themselves, bad values or constraint violations.
+# Anything else, a dropped connection in particular, fails the whole batch.
+row_errors = (pyodbc.DataError, pyodbc.IntegrityError, pyodbc.ProgrammingError)
+
+def dbapi_connection(connection):
+    """
+    Returns the pyodbc connection behind a SQLAlchemy connection
+
+    Params:
+        connection: SQLAlchemy connection or pyodbc connection
+
+    Return:
+        DBAPI connection with cursor() and commit()
+    """
+    if hasattr(connection, "cursor"):
+        return connection
+
+    return connection.connection
+
+def input_size(sql_type):
+    """
+    Maps a SQLAlchemy column type to a pyodbc input size
+
+    Params:
+        sql_type: SQLAlchemy type class or instance from a schema dict
+
+    Return:
+        pyodbc setinputsizes entry, None lets pyodbc infer it
+    """
+    if isinstance(sql_type, type):
+        sql_type = sql_type()
+
+    if isinstance(sql_type, sal.String):
+        # length 0 sends NVARCHAR(MAX) without falling back to slow streaming
+        return (pyodbc.SQL_WVARCHAR, sql_type.length or 0, 0)
+    if isinstance(sql_type, sal.Integer):
+        return (pyodbc.SQL_INTEGER, 0, 0)
+    if isinstance(sql_type, (sal.Numeric, sal.Float)):
+        # sent as double, SQL Server casts to the column's DECIMAL on insert
+        return (pyodbc.SQL_DOUBLE, 0, 0)
+
+    return None
+
+def input_sizes_for_frame(df, columns):
+    """
+    Infers pyodbc input sizes from dataframe dtypes, for tables without a
+    schema dict
+
+    Params:
+        df: Dataframe to insert
+        columns: Columns in insert order
+
+    Return:
+        List of pyodbc input sizes
+    """
+    sizes = []
+    for column in columns:
+        kind = df[column].dtype.kind
+        if kind in "iu":
+            sizes.append((pyodbc.SQL_BIGINT, 0, 0))
+        elif kind == "f":
+            sizes.append((pyodbc.SQL_DOUBLE, 0, 0))
+        else:
+            sizes.append((pyodbc.SQL_WVARCHAR, 0, 0))
+
+    return sizes
+
+def frame_to_rows(df, columns):
+    """
+    Converts a dataframe to parameter tuples, one column at a time
+
+    Params:
+        df: Dataframe to convert
+        columns: Columns in insert order
+
+    Return:
+        List of tuples with NaN replaced by None
+    """
+    arrays = []
+    for column in columns:
+        s = df[column].astype(object)
+        arrays.append(s.where(s.notna(), None).tolist())
+
+    return list(zip(*arrays))
+
+class InsertPlan:
+    """
+    Typed insert statement built from a schema dict
+
+    Params:
+        table_name: Target table in dbo
+        schema: Dict of column name to SQLAlchemy type, in table order
+    """
+
+    def __init__(self, table_name, schema):
+        self.table_name = table_name
+        self.schema = schema
+        self.columns = list(schema.keys())
+        self.input_sizes = [input_size(t) for t in schema.values()]
+
+        column_names = ",".join(f"[{c}]" for c in self.columns)
+        value_marks = ",".join("?" * len(self.columns))
+        self.sql = f"INSERT INTO [dbo].[{table_name}] ({column_names}) VALUES ({value_marks})"
+
+    def create_table_sql(self):
+        """
+        Builds the CREATE TABLE statement for the schema
+
+        Return:
+            SQL string
+        """
+        table = sal.Table(
+            self.table_name,
+            sal.MetaData(),
+            *[sal.Column(c, t) for c, t in self.schema.items()],
+            schema="dbo",
+        )
+
+        return str(sal.schema.CreateTable(table).compile(dialect=mssql.dialect()))
+
+    def create_table(self, connection, replace=True):
+        """
+        Creates the target table, dropping an existing one first if asked
+
+        Params:
+            connection: SQLAlchemy or pyodbc connection
+            replace: Drop the table if it already exists
+        """
+        raw = dbapi_connection(connection)
+        cursor = raw.cursor()
+        if replace:
+            cursor.execute(f"DROP TABLE IF EXISTS [dbo].[{self.table_name}]")
+        cursor.execute(self.create_table_sql())
+        raw.commit()
+
+def bisect_insert(connection, sql, rows, input_sizes=None):
+    """
+    Inserts rows, splitting a failing batch in half until the bad rows are
+    isolated
+
+    Each half is committed on its own, so good rows still load. With k bad
+    rows in n this takes O(k log n) round trips instead of n. Only
+    row_errors are bisected, other errors are raised and may leave some
+    halves committed, see delete_keys for clearing them before a retry.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        sql: Parameterised INSERT statement
+        rows: List of parameter tuples
+        input_sizes: Optional pyodbc input sizes, one per parameter
+
+    Return:
+        (rows inserted, list of (row, error) for rows that failed) tuple
+    """
+    if not rows:
+        return 0, []
+
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+    cursor.fast_executemany = True
+
+    try:
+        if input_sizes is not None:
+            cursor.setinputsizes(input_sizes)
+        cursor.executemany(sql, rows)
+        raw.commit()
+        return len(rows), []
+    except row_errors as e:
+        raw.rollback()
+        if len(rows) == 1:
+            return 0, [(rows[0], str(e))]
+
+    middle = len(rows) // 2
+    left = bisect_insert(connection, sql, rows[:middle], input_sizes)
+    right = bisect_insert(connection, sql, rows[middle:], input_sizes)
+
+    return left[0] + right[0], left[1] + right[1]
+
+def delete_keys(connection, table, key, keys):
+    """
+    Deletes the rows with the given keys, e.g. a batch left partly loaded
+
+    The keys go into a keyed temp table and are deleted with one join, so
+    a table without an index on key is scanned once rather than per key.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        table: Table name in dbo
+        key: Integer key column
+        keys: Key values to delete
+
+    Return:
+        Number of rows deleted
+    """
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+    cursor.execute("DROP TABLE IF EXISTS #delete_keys")
+    cursor.execute("CREATE TABLE #delete_keys ([key] INT NOT NULL PRIMARY KEY)")
+
+    cursor.fast_executemany = True
+    cursor.executemany(
+        "INSERT INTO #delete_keys ([key]) VALUES (?)", [(int(k),) for k in np.unique(np.asarray(keys))]
+    )
+    cursor.execute(
+        f"""
+        DELETE t FROM [dbo].[{table}] AS t
+        JOIN #delete_keys AS d ON t.[{key}] = d.[key]
+        """
+    )
+    deleted = cursor.rowcount
+    cursor.execute("DROP TABLE #delete_keys")
+    raw.commit()
+
+    return deleted
+
+def insert_rows(connection, sql, rows, input_sizes=None, batch_size=20000, fallback=False):
+    """
+    Inserts rows in large fast_executemany batches, committing each batch
+
+    The statement is prepared once and reused for every batch. If a batch
+    fails it is rolled back and the error raised. With fallback it is
+    retried with bisect_insert instead, so only the bad rows are lost, for
+    callers that can live with a partial load.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        sql: Parameterised INSERT statement
+        rows: List of parameter tuples
+        input_sizes: Optional pyodbc input sizes, one per parameter
+        batch_size: Rows per executemany call
+        fallback: Retry failed batches by bisection instead of raising
+
+    Return:
+        (rows inserted, list of (row, error) for rows that failed) tuple
+    """
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+    cursor.fast_executemany = True
+
+    inserted = 0
+    failed = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start : start + batch_size]
+        try:
+            if input_sizes is not None:
+                cursor.setinputsizes(input_sizes)
+            cursor.executemany(sql, batch)
+            raw.commit()
+            inserted += len(batch)
+        except pyodbc.Error as e:
+            raw.rollback()
+            if not fallback:
+                raise
+            print(f"batch at row {start} failed, bisecting: {e}")
+            batch_inserted, batch_failed = bisect_insert(connection, sql, batch, input_sizes)
+            inserted += batch_inserted
+            failed.extend(batch_failed)
+
+    return inserted, failed
+
+def _load_partition(connect, plan, part, batch_size, number, key):
+    """
+    Loads one partition over its own connection
+
+    Params:
+        connect: Callable returning a new DBAPI connection
+        plan: InsertPlan
+        part: Dataframe partition
+        batch_size: Rows per executemany call
+        number: Partition number, for reporting
+        key: Column the partitions are ranged on
+
+    Return:
+        (rows inserted, failed rows) tuple
+    """
+    connection = connect()
+    try:
+        start = time.perf_counter()
+        rows = frame_to_rows(part, plan.columns)
+        inserted, failed = insert_rows(connection, plan.sql, rows, plan.input_sizes, batch_size)
+        elapsed = time.perf_counter() - start
+        print(
+            f"partition {number} ({key} {part[key].min()} to {part[key].max()}): "
+            f"{inserted} rows in {elapsed:.1f}s ({inserted / max(elapsed, 1e-9):.0f} rows/sec)"
+        )
+    finally:
+        connection.close()
+
+    return inserted, failed
+
+def parallel_load(connect, plan, df, workers=4, batch_size=20000, key="location_id"):
+    """
+    Loads a dataframe concurrently, one connection per location_id range
+
+    Rows are sorted by key and split into contiguous ranges of equal size.
+    Each range is inserted and committed on its own connection, so the
+    target should be a heap without indexes to avoid contention.
+
+    Params:
+        connect: Callable returning a new DBAPI connection
+        plan: InsertPlan for the target table
+        df: Dataframe with the plan's columns
+        workers: Number of concurrent connections
+        batch_size: Rows per executemany call
+        key: Column to range partition on
+
+    Return:
+        (rows inserted, failed rows) tuple
+    """
+    df = df.sort_values(key, kind="stable")
+    parts = [df.iloc[p] for p in np.array_split(np.arange(len(df)), workers) if len(p)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(
+            pool.map(
+                lambda x: _load_partition(connect, plan, x[1], batch_size, x[0], key),
+                enumerate(parts),
+            )
+        )
+
+    inserted = sum(r[0] for r in results)
+    failed = [f for r in results for f in r[1]]
+
+    return inserted, failed
+
+def bulk_load(
+    connection,
+    table_name,
+    df,
+    schema,
+    if_exists="replace",
+    batch_size=20000,
+    workers=1,
+    connect=None,
+):
+    """
+    Loads a dataframe into a table using a typed insert plan
+
+    Replaces DataFrame.to_sql, which sends row by row parameterised inserts.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        table_name: Target table in dbo
+        df: Dataframe with the schema's columns
+        schema: Dict of column name to SQLAlchemy type
+        if_exists: "replace" to recreate the table, "append" to insert into it
+        batch_size: Rows per executemany call
+        workers: Concurrent connections, more than 1 loads location_id
+            ranges in parallel
+        connect: Callable returning a new DBAPI connection for parallel
+            loads, defaults to the SQLAlchemy engine's raw_connection
+
+    Return:
+        Number of rows inserted
+    """
+    plan = InsertPlan(table_name, schema)
+    if if_exists == "replace":
+        plan.create_table(connection)
+
+    start = time.perf_counter()
+    if workers > 1:
+        connect = connect or connection.engine.raw_connection
+        inserted, failed = parallel_load(connect, plan, df, workers, batch_size)
+    else:
+        rows = frame_to_rows(df, plan.columns)
+        inserted, failed = insert_rows(connection, plan.sql, rows, plan.input_sizes, batch_size)
+    if failed:
+        # never index or swap live a table with rows missing
+        raise RuntimeError(f"{len(failed)} rows failed to load into {table_name}")
+
+    elapsed = time.perf_counter() - start
+    print(f"loaded {inserted} rows into {table_name} in {elapsed:.1f}s ({inserted / max(elapsed, 1e-9):.0f} rows/sec)")
+
+    return inserted
+
+def build_indexes(connection, table_name, index_name=None, key="location_id", columnstore=False):
+    """
+    Builds indexes on a freshly loaded heap
+
+    Building after the load is much cheaper than maintaining the indexes
+    row by row during the insert.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        table_name: Loaded table in dbo
+        index_name: Table name used in the index names, defaults to table_name
+        key: Column to index
+        columnstore: Build a clustered columnstore index, for wide analysis
+            tables, plus a nonclustered index on key
+    """
+    index_name = index_name or table_name
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+
+    start = time.perf_counter()
+    if columnstore:
+        cursor.execute(
+            f"CREATE CLUSTERED COLUMNSTORE INDEX [CCI_{index_name}] ON [dbo].[{table_name}]"
+        )
+        cursor.execute(
+            f"CREATE NONCLUSTERED INDEX [IX_{index_name}_{key}] ON [dbo].[{table_name}] ([{key}])"
+        )
+    else:
+        cursor.execute(
+            f"CREATE CLUSTERED INDEX [CIX_{index_name}_{key}] ON [dbo].[{table_name}] ([{key}])"
+        )
+    raw.commit()
+
+    print(f"built indexes on {table_name} in {time.perf_counter() - start:.1f}s")
+
+def execute_atomic(connection, sql):
+    """
+    Runs a multi-statement batch as one all-or-nothing transaction
+
+    pyodbc only raises the first statement's error from execute(), later
+    ones surface while stepping through the result sets, and without
+    XACT_ABORT SQL Server keeps the statements that did succeed. The batch
+    is wrapped in XACT_ABORT and an explicit transaction, and every result
+    set is read before committing, so any failing statement rolls back the
+    whole batch and raises.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        sql: T-SQL statements
+    """
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+
+    try:
+        cursor.execute(
+            f"""
+            SET XACT_ABORT ON;
+            BEGIN TRANSACTION;
+            {sql}
+            COMMIT TRANSACTION;
+            """
+        )
+        while cursor.nextset():
+            pass
+        raw.commit()
+    except pyodbc.Error:
+        raw.rollback()
+        raise
+
+def swap_table(connection, staging_name, table_name, drop_old=False):
+    """
+    Swaps a loaded staging table into the live name in one transaction
+
+    The live table is renamed to {table_name}_old and the staging table takes
+    its name. Readers see either the old or the new table, never a half
+    loaded one.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        staging_name: Loaded and indexed staging table in dbo
+        table_name: Live table name
+        drop_old: Drop the previous live table after the swap
+    """
+    old_name = f"{table_name}_old"
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+
+    cursor.execute(f"DROP TABLE IF EXISTS [dbo].[{old_name}]")
+    raw.commit()
+
+    execute_atomic(
+        connection,
+        f"""
+        IF OBJECT_ID(N'[dbo].[{table_name}]', N'U') IS NOT NULL
+            EXEC sp_rename N'[dbo].[{table_name}]', N'{old_name}';
+        EXEC sp_rename N'[dbo].[{staging_name}]', N'{table_name}';
+        """,
+    )
+    print(f"swapped {staging_name} into {table_name}")
+
+    if drop_old:
+        cursor.execute(f"DROP TABLE IF EXISTS [dbo].[{old_name}]")
+        raw.commit()
+
+def staged_load(
+    connection,
+    table_name,
+    df,
+    schema,
+    swap=True,
+    columnstore=False,
+    batch_size=20000,
+    workers=1,
+    drop_old=False,
+):
+    """
+    Loads a dataframe into an index-free heap, indexes it, then swaps it live
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        table_name: Target table in dbo
+        df: Dataframe with the schema's columns
+        schema: Dict of column name to SQLAlchemy type
+        swap: Load into {table_name}_staging and swap it into table_name.
+            False loads straight into table_name, for tables that are
+            validated and renamed by hand
+        columnstore: Use a clustered columnstore index, see build_indexes
+        batch_size: Rows per executemany call
+        workers: Concurrent connections, see bulk_load
+        drop_old: Drop the replaced live table after the swap
+
+    Return:
+        Number of rows inserted
+    """
+    load_name = f"{table_name}_staging" if swap else table_name
+
+    inserted = bulk_load(
+        connection,
+        load_name,
+        df,
+        schema,
+        if_exists="replace",
+        batch_size=batch_size,
+        workers=workers,
+    )
+    build_indexes(connection, load_name, index_name=table_name, columnstore=columnstore)
+
+    if swap:
+        swap_table(connection, load_name, table_name, drop_old=drop_old)
+
+    return inserted
@@ -0,0 +1,73 @@
+import os
+import json
+import threading
+from pathlib import Path
+
+class Checkpoint:
+    """
+    On-disk manifest of completed work units and failed ids
+
+    The manifest is rewritten atomically after every unit, so a crash never
+    leaves it half written. A run started with resume=True skips the units
+    recorded as completed. mark_done is safe to call from several threads.
+
+    Params:
+        path: Path to the JSON manifest
+        resume: Load an existing manifest instead of starting fresh
+        source: JSON-serializable description of the input and unit layout,
+            e.g. file path, size and batch size. Resuming a manifest written
+            for a different source raises ValueError
+    """
+
+    def __init__(self, path, resume=False, source=None):
+        self.path = Path(path)
+        self.source = source
+        self.completed = set()
+        self.failed = []
+        self._lock = threading.Lock()
+
+        if resume and self.path.exists():
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest.get("source") != source:
+                raise ValueError(
+                    f"{self.path} was written for {manifest.get('source')}, not {source}. "
+                    "Delete it or turn resume off to start over"
+                )
+            self.completed = set(manifest["completed"])
+            self.failed = manifest["failed"]
+            print(f"resuming from {self.path}: {len(self.completed)} units done, {len(self.failed)} failed ids")
+
+    def is_done(self, unit):
+        """
+        Checks whether a unit was completed by this or a previous run
+
+        Params:
+            unit: Unit name, e.g. "0:1000"
+
+        Return:
+            True if the unit can be skipped
+        """
+        return str(unit) in self.completed
+
+    def mark_done(self, unit, failed_ids=()):
+        """
+        Records a completed unit and the ids that failed in it
+
+        Params:
+            unit: Unit name
+            failed_ids: Ids that could not be loaded
+        """
+        with self._lock:
+            self.completed.add(str(unit))
+            self.failed.extend(failed_ids)
+            self._save()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"source": self.source, "completed": sorted(self.completed), "failed": self.failed}, f
+            )
+        os.replace(tmp_path, self.path)
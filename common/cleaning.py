@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+# Inferred object dtypes that may hold Python bools next to other values
+_maybe_bool = {"boolean", "mixed", "mixed-integer"}
+
+def schema_columns(schema, type_name):
+    """
+    Lists the schema columns of one SQL type
+
+    Params:
+        schema: Dict of column name to SQLAlchemy type
+        type_name: Type name to look for, e.g. "NVARCHAR" or "DECIMAL"
+
+    Return:
+        Column names in schema order
+    """
+    return [k for k, v in schema.items() if type_name in str(v)]
+
+def _bool_mask(s):
+    """
+    Finds the bool cells of a column without visiting every cell where possible
+
+    Return:
+        Boolean array, or None if the column cannot hold bools
+    """
+    if pd.api.types.is_bool_dtype(s.dtype):
+        return s.notna().to_numpy()
+
+    if s.dtype != object:
+        return None
+
+    inferred = pd.api.types.infer_dtype(s, skipna=True)
+    if inferred == "boolean":
+        return s.notna().to_numpy()
+    if inferred in _maybe_bool:
+        # only mixed columns pay for a per-cell type check
+        return s.map(type).eq(bool).to_numpy()
+
+    return None
+
+def bool_to_text(df, columns=None):
+    """
+    Replaces bool values with "true" / "false", one column at a time
+
+    Params:
+        df: Dataframe to convert, changed in place
+        columns: Columns to check, all columns if None
+
+    Return:
+        df
+    """
+    for column in df.columns if columns is None else columns:
+        if column not in df.columns:
+            continue
+        s = df[column]
+        mask = _bool_mask(s)
+        if mask is None or not mask.any():
+            continue
+
+        values = s.to_numpy(dtype=object, na_value=None).copy()
+        values[mask] = np.where(values[mask].astype(bool), "true", "false")
+        df[column] = values
+
+    return df
+
+def nvarchar_default(df, columns, default="{}"):
+    """
+    Fills nulls in NVARCHAR columns with a default
+
+    Params:
+        df: Dataframe to convert, changed in place
+        columns: NVARCHAR columns
+        default: Value stored instead of NULL
+
+    Return:
+        df
+    """
+    for column in columns:
+        if column in df.columns:
+            df[column] = df[column].fillna(default)
+
+    return df
+
+def decimal_to_numeric(df, columns):
+    """
+    Converts DECIMAL columns that were not read as numbers to float
+
+    Params:
+        df: Dataframe to convert, changed in place
+        columns: DECIMAL columns
+
+    Return:
+        df with unparseable values as NaN
+    """
+    for column in columns:
+        if column in df.columns and not pd.api.types.is_numeric_dtype(df[column].dtype):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+
+    return df
+
+def conform(df, columns):
+    """
+    Selects columns in table order, adding missing ones as nulls
+
+    Params:
+        df: Dataframe to reorder
+        columns: Column names in table order
+
+    Return:
+        New dataframe with exactly these columns
+    """
+    missing = [c for c in columns if c not in df.columns]
+    if missing:
+        df = pd.concat([df, pd.DataFrame(None, index=df.index, columns=missing, dtype=object)], axis=1)
+
+    return df[list(columns)]
+
+def clean_for_schema(df, schema):
+    """
+    Conforms a dataframe to a table schema for loading
+
+    Columns are reordered to the schema, bools in NVARCHAR columns become
+    "true" / "false", NVARCHAR nulls become "{}" and DECIMAL columns are
+    made numeric. Each step works on whole columns, so no Python call is
+    made per cell except in object columns that mix bools with other values.
+
+    Params:
+        df: Dataframe with renamed columns
+        schema: Dict of column name to SQLAlchemy type, in table order
+
+    Return:
+        Cleaned dataframe
+    """
+    nvarchar_cols = schema_columns(schema, "NVARCHAR")
+
+    df = conform(df, list(schema.keys())).copy()
+    bool_to_text(df, nvarchar_cols)
+    nvarchar_default(df, nvarchar_cols)
+    decimal_to_numeric(df, schema_columns(schema, "DECIMAL"))
+
+    return df
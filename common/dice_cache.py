@@ -0,0 +1,139 @@
+import time
+import pickle
+import sqlite3
+import hashlib
+
+class DiceCache:
+    """
+    On-disk cache of diced pieces, keyed by a hash of the input geometry
+
+    Entries live in a single SQLite file. Each entry holds the WKB pieces and
+    the grid columns dicing produced for one input geometry. When the file
+    grows past max_bytes the least recently used entries are evicted.
+
+    Params:
+        path: Path to the SQLite cache file
+        max_bytes: Size cap for the cached pieces
+    """
+
+    def __init__(self, path, max_bytes=2 * 1024**3):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pieces (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                used REAL NOT NULL
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pieces_used ON pieces (used)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(wkb, signature):
+        """
+        Builds a cache key
+
+        Params:
+            wkb: WKB of the input geometry
+            signature: String describing the dicing options, e.g. grid size
+
+        Return:
+            Hex digest
+        """
+        return hashlib.sha256(signature.encode() + b"\x00" + wkb).hexdigest()
+
+    def get_many(self, keys, chunk_size=500):
+        """
+        Looks up many keys at once and counts hits and misses
+
+        Params:
+            keys: List of cache keys
+            chunk_size: Keys per SQL query
+
+        Return:
+            Dict of key to cached value for the keys that were found
+        """
+        found = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i : i + chunk_size]
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(
+                f"SELECT key, value FROM pieces WHERE key IN ({marks})", chunk
+            ).fetchall()
+            found.update((k, pickle.loads(v)) for k, v in rows)
+
+        if found:
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE pieces SET used = ? WHERE key = ?", [(now, k) for k in found]
+            )
+            self.conn.commit()
+
+        self.hits += sum(k in found for k in keys)
+        self.misses += sum(k not in found for k in keys)
+
+        return found
+
+    def put_many(self, items):
+        """
+        Stores many entries and evicts old ones past the size cap
+
+        Params:
+            items: Dict of key to value
+        """
+        now = time.time()
+        rows = []
+        for k, v in items.items():
+            blob = pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((k, blob, len(blob), now))
+
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO pieces (key, value, size, used) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+        self._evict()
+
+    def _evict(self):
+        """
+        Deletes least recently used entries until the cache fits max_bytes
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pieces").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        evict = []
+        for key, size in self.conn.execute("SELECT key, size FROM pieces ORDER BY used"):
+            if total <= self.max_bytes:
+                break
+            evict.append((key,))
+            total -= size
+
+        self.conn.executemany("DELETE FROM pieces WHERE key = ?", evict)
+        self.conn.commit()
+        print(f"evicted {len(evict)} dice cache entries")
+
+    def report(self):
+        """
+        Prints the hit rate since the cache was opened
+        """
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        print(f"dice cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
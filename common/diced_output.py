@@ -0,0 +1,119 @@
+import json
+import shapely
+import pandas as pd
+
+class DicedWriter:
+    """
+    Writes diced pieces in one or more batches
+
+    The default "tsv" format keeps the hex WKB text file Geotrellis reads
+    today. "parquet" writes GeoParquet with binary WKB and compression, which
+    is smaller and cheaper to encode.
+
+    Params:
+        path: Output file path
+        fmt: "tsv" or "parquet"
+        compression: Parquet compression codec
+    """
+
+    def __init__(self, path, fmt="tsv", compression="zstd"):
+        if fmt not in ("tsv", "parquet"):
+            raise ValueError(f"Unknown diced output format {fmt}")
+
+        self.path = str(path)
+        self.fmt = fmt
+        self.compression = compression
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+        self._empty = None
+
+    def write(self, gdf, columns):
+        """
+        Appends a batch of diced pieces
+
+        Params:
+            gdf: Diced geodataframe
+            columns: Attribute columns to write before the geom column
+        """
+        geoms = gdf.geometry.values
+
+        if self.fmt == "tsv":
+            df = pd.DataFrame(gdf[columns])
+            df["geom"] = shapely.to_wkb(geoms, hex=True)  # vectorized, one call per batch
+            df.to_csv(
+                self.path,
+                sep="\t",
+                index=False,
+                mode="w" if self.rows == 0 else "a",
+                header=self.rows == 0,
+            )
+        else:
+            self._write_parquet(pd.DataFrame(gdf[columns]), shapely.to_wkb(geoms))
+
+        self.rows += len(gdf)
+
+    def _write_parquet(self, df, wkbs):
+        """
+        Appends a batch to the GeoParquet file
+
+        Params:
+            df: Attribute columns
+            wkbs: Array of WKB bytes
+        """
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.append_column("geom", pa.array(wkbs, type=pa.binary()))
+
+        if self._writer is None:
+            if table.num_rows == 0:
+                # an empty batch has no values to type its object columns
+                # from, so the schema waits for the first batch with rows
+                self._empty = table
+                return
+            self._open_parquet(table.schema)
+
+        self._writer.write_table(table.cast(self._schema))
+
+    def _open_parquet(self, schema):
+        """
+        Opens the Parquet writer with a fixed schema and GeoParquet metadata
+
+        Params:
+            schema: Arrow schema of the first batch, columns typed null
+                (all missing) are stored as strings
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema(
+            [f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in schema]
+        )
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geom",
+            "columns": {"geom": {"encoding": "WKB", "geometry_types": []}},
+        }
+        self._schema = schema.with_metadata({b"geo": json.dumps(geo).encode()})
+        self._writer = pq.ParquetWriter(self.path, self._schema, compression=self.compression)
+
+    def close(self):
+        """
+        Finishes the output file
+        """
+        if self._writer is None and self._empty is not None:
+            # every batch was empty, still leave a valid file behind
+            self._open_parquet(self._empty.schema)
+            self._writer.write_table(self._empty.cast(self._schema))
+            self._empty = None
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
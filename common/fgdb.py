@@ -0,0 +1,52 @@
+import geopandas as gpd
+
+def feature_count(path, layer):
+    """
+    Reads the feature count of a layer from its metadata
+
+    Params:
+        path: Path to the FGDB
+        layer: Layer name or index
+
+    Return:
+        Number of features in the layer
+    """
+    try:
+        import pyogrio
+
+        count = pyogrio.read_info(path, layer=layer)["features"]
+        if count >= 0:
+            return count
+    except ImportError:
+        pass
+
+    import fiona
+
+    with fiona.open(path, layer=layer) as src:
+        return len(src)
+
+def read_windows(path, layer, window_size, start=0):
+    """
+    Reads a layer in row windows
+
+    The index of every window continues from the previous one, so it matches
+    the index a full read of the layer would produce.
+
+    Params:
+        path: Path to the FGDB
+        layer: Layer name or index
+        window_size: Number of rows per window
+        start: Row to start reading from
+
+    Yields:
+        Geodataframe per window
+    """
+    total = feature_count(path, layer)
+    print(f"reading {total} features from {layer} in windows of {window_size}")
+
+    for offset in range(start, total, window_size):
+        gdf = gpd.read_file(
+            path, driver="FileGDB", layer=layer, rows=slice(offset, offset + window_size)
+        )
+        gdf.index = gdf.index + offset
+        yield gdf
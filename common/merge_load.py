@@ -0,0 +1,195 @@
+import time
+import pandas as pd
+import sqlalchemy as sal
+from common.bulk_load import bulk_load, dbapi_connection, execute_atomic, staged_load
+
+def row_hashes(df, columns):
+    """
+    Computes a 64-bit hash per row over the given columns
+
+    pandas hashes with a fixed key, so the same values hash the same way in
+    every run.
+
+    Params:
+        df: Cleaned dataframe
+        columns: Columns that make up the row
+
+    Return:
+        Series of int64 hashes with the same index as df
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).astype("int64")
+
+def _table_exists(cursor, table_name):
+    """
+    Checks whether a dbo table exists
+
+    Params:
+        cursor: pyodbc cursor
+        table_name: Table name in dbo
+
+    Return:
+        True if the table exists
+    """
+    cursor.execute(f"SELECT OBJECT_ID(N'[dbo].[{table_name}]', N'U')")
+    return cursor.fetchone()[0] is not None
+
+def _stored_hashes(cursor, hash_table, key):
+    """
+    Reads the row hashes saved by the previous load
+
+    Params:
+        cursor: pyodbc cursor
+        hash_table: Hash table name in dbo
+        key: Key column
+
+    Return:
+        Series of hashes indexed by key, empty if there are none
+    """
+    if not _table_exists(cursor, hash_table):
+        return pd.Series(dtype="Int64")
+
+    cursor.execute(f"SELECT [{key}], [row_hash] FROM [dbo].[{hash_table}]")
+    rows = cursor.fetchall()
+
+    return pd.Series([r[1] for r in rows], index=[r[0] for r in rows], dtype="Int64")
+
+def _live_keys(cursor, table_name, key):
+    """
+    Reads the keys currently in a table
+
+    Params:
+        cursor: pyodbc cursor
+        table_name: Table name in dbo
+        key: Key column
+
+    Return:
+        Index of keys
+    """
+    cursor.execute(f"SELECT [{key}] FROM [dbo].[{table_name}]")
+
+    return pd.Index([r[0] for r in cursor.fetchall()])
+
+def merge_load(
+    connection,
+    table_name,
+    df,
+    schema,
+    key="location_id",
+    batch_size=20000,
+    workers=1,
+    deleted_keys=None,
+):
+    """
+    Applies only changed rows to a table with a hash-driven MERGE
+
+    Every row is hashed over the schema columns and compared with the hashes
+    saved in {table_name}_rowhash by the previous load. New and changed rows
+    are loaded into a staging heap and merged in, and keys that disappeared
+    are deleted, so the work is proportional to the change. The first run,
+    with no saved hashes, upserts everything, deletes live keys missing from
+    df and seeds the hash table.
+
+    With deleted_keys the load is a delta: df holds only new and changed
+    rows, keys missing from it are left alone, and only deleted_keys are
+    removed, e.g. from the deleted_locations.txt of an incremental prep.
+
+    Params:
+        connection: SQLAlchemy or pyodbc connection
+        table_name: Target table in dbo
+        df: Cleaned dataframe with the schema's columns
+        schema: Dict of column name to SQLAlchemy type
+        key: Unique key column
+        batch_size: Rows per executemany call
+        workers: Concurrent connections, see bulk_load
+        deleted_keys: Keys to delete in delta mode, None for a full load
+
+    Return:
+        (rows upserted, keys deleted) tuple
+    """
+    columns = list(schema.keys())
+    hash_table = f"{table_name}_rowhash"
+    merge_table = f"{table_name}_merge"
+    delete_table = f"{table_name}_delete"
+    key_schema = {key: sal.INTEGER}
+
+    raw = dbapi_connection(connection)
+    cursor = raw.cursor()
+
+    hashes = row_hashes(df, columns)
+    hashes.index = df[key].values
+    current = pd.DataFrame({key: df[key].values, "row_hash": hashes.values})
+
+    delta = deleted_keys is not None
+    if not _table_exists(cursor, table_name):
+        if delta:
+            raise ValueError(f"{table_name} does not exist, a delta cannot be merged into it")
+        print(f"{table_name} does not exist, loading it in full")
+        inserted = staged_load(
+            connection, table_name, df, schema, swap=False, batch_size=batch_size, workers=workers
+        )
+        bulk_load(connection, hash_table, current, {**key_schema, "row_hash": sal.BIGINT})
+        return inserted, 0
+
+    has_hashes = _table_exists(cursor, hash_table)
+    stored = _stored_hashes(cursor, hash_table, key)
+    previous = stored.reindex(hashes.index)
+    is_changed = previous.isna().values | (previous.fillna(0).astype("int64").values != hashes.values)
+    changed = df[is_changed]
+    if delta:
+        deleted = pd.Index(pd.unique(pd.Series(deleted_keys).dropna())).difference(hashes.index)
+    elif has_hashes:
+        deleted = stored.index.difference(hashes.index)
+    else:
+        # nothing saved yet, live rows this load does not have are stale
+        deleted = _live_keys(cursor, table_name, key).difference(hashes.index)
+    print(f"{len(changed)} new or changed rows, {len(deleted)} removed {key}s")
+
+    start = time.perf_counter()
+    staged = bulk_load(connection, merge_table, changed, schema, batch_size=batch_size, workers=workers)
+    staged_deletes = bulk_load(connection, delete_table, pd.DataFrame({key: deleted}), key_schema)
+
+    # the hashes saved below assume every changed row reached the target, so
+    # a short staging load must stop here or those rows are never retried
+    if staged != len(changed) or staged_deletes != len(deleted):
+        raise RuntimeError(
+            f"staged {staged} of {len(changed)} changed rows and {staged_deletes} of "
+            f"{len(deleted)} deletions for {table_name}, not merging"
+        )
+
+    column_names = ",".join(f"[{c}]" for c in columns)
+    source_names = ",".join(f"s.[{c}]" for c in columns)
+    set_tokens = ",".join(f"t.[{c}] = s.[{c}]" for c in columns if c != key)
+    # MERGE and DELETE commit together or not at all
+    execute_atomic(
+        connection,
+        f"""
+        MERGE [dbo].[{table_name}] AS t
+        USING [dbo].[{merge_table}] AS s
+            ON t.[{key}] = s.[{key}]
+        WHEN MATCHED THEN
+            UPDATE SET {set_tokens}
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT ({column_names}) VALUES ({source_names});
+
+        DELETE t
+        FROM [dbo].[{table_name}] AS t
+        JOIN [dbo].[{delete_table}] AS d
+            ON t.[{key}] = d.[{key}];
+        """,
+    )
+
+    cursor.execute(f"DROP TABLE IF EXISTS [dbo].[{merge_table}]")
+    cursor.execute(f"DROP TABLE IF EXISTS [dbo].[{delete_table}]")
+    raw.commit()
+    print(f"merged into {table_name} in {time.perf_counter() - start:.1f}s")
+
+    if delta:
+        # keys outside the delta keep the hashes they already had
+        kept = stored[~stored.index.isin(deleted) & ~stored.index.isin(hashes.index)]
+        current = pd.concat(
+            [pd.DataFrame({key: kept.index, "row_hash": kept.astype("int64").values}), current],
+            ignore_index=True,
+        )
+    bulk_load(connection, hash_table, current, {**key_schema, "row_hash": sal.BIGINT})
+
+    return len(changed), len(deleted)
@@ -0,0 +1,175 @@
+import pandas as pd
+
+def read_header(path, sep="\t"):
+    """
+    Reads the column names of a result file without parsing any rows
+
+    Params:
+        path: Path to the result TSV
+        sep: Field separator
+
+    Return:
+        List of column names in file order
+    """
+    with open(path, encoding="utf-8") as f:
+        return f.readline().rstrip("\r\n").split(sep)
+
+def result_dtypes(columns, schema=None, rename=None):
+    """
+    Chooses dtypes so the parser does not infer them for wide columns
+
+    *_yearly columns are JSON text and are read as strings. Columns that end
+    up as DECIMAL in the schema are read as float64. Everything else is left
+    to the parser.
+
+    Params:
+        columns: Column names as they appear in the file
+        schema: Dict of DB column name to SQLAlchemy type, optional
+        rename: Dict of file column name to DB column name, optional
+
+    Return:
+        Dict of column name to dtype
+    """
+    schema = schema or {}
+    rename = rename or {}
+    dtypes = {}
+    for column in columns:
+        if column.endswith("_yearly"):
+            dtypes[column] = str
+        elif "DECIMAL" in str(schema.get(rename.get(column, column), "")):
+            dtypes[column] = "float64"
+
+    return dtypes
+
+def _arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+
+    return True
+
+def _text_to_object(df):
+    """
+    Stores text columns as object with None for missing cells
+
+    The two parsers and pandas versions disagree on how missing text is
+    represented (NaN, None, pd.NA), this gives one representation that
+    fillna and the DB drivers both treat as NULL.
+
+    Params:
+        df: Parsed dataframe, changed in place
+
+    Return:
+        df
+    """
+    for column in df.columns:
+        dtype = df[column].dtype
+        if dtype == object or pd.api.types.is_string_dtype(dtype):
+            values = df[column].astype(object)
+            df[column] = values.where(values.notna(), None).astype(object)
+
+    return df
+
+def _read_arrow(path, sep, usecols, dtypes):
+    """
+    Parses with pyarrow.csv, typing the columns inside Arrow
+
+    Types are applied while parsing, so empty *_yearly cells stay null
+    instead of being turned into "nan" / "None" by a later astype(str).
+
+    Return:
+        Dataframe
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+
+    column_types = {c: pa.string() if t is str else pa.float64() for c, t in dtypes.items()}
+    table = csv.read_csv(
+        path,
+        parse_options=csv.ParseOptions(delimiter=sep),
+        convert_options=csv.ConvertOptions(
+            include_columns=usecols, column_types=column_types, strings_can_be_null=True
+        ),
+    )
+
+    return table.to_pandas()
+
+def _read_c(path, sep, usecols, dtypes, chunksize):
+    """
+    Parses with the pandas C engine, optionally in chunks
+
+    Return:
+        Dataframe, or a chunk generator if chunksize is set
+    """
+    reader = pd.read_csv(
+        path, sep=sep, usecols=usecols, dtype=dtypes, engine="c", chunksize=chunksize
+    )
+    if chunksize is None:
+        return _text_to_object(reader)
+
+    return (_text_to_object(chunk) for chunk in reader)
+
+def read_results(
+    path, columns=None, exclude=(), schema=None, rename=None, sep="\t", chunksize=None, engine=None
+):
+    """
+    Reads a Geotrellis result TSV, keeping only the columns that are loaded
+
+    Only columns in both the header and columns are parsed, with dtypes from
+    result_dtypes. The multithreaded pyarrow parser is used when it is
+    installed. Chunked reads and reads without pyarrow use the C parser.
+    Both return the same frame, text columns as object with None for
+    missing cells, see engines_agree.
+
+    Params:
+        path: Path to the result TSV
+        columns: File column names to keep, all if None
+        exclude: File column names to skip even if listed in columns
+        schema: Dict of DB column name to SQLAlchemy type, see result_dtypes
+        rename: Dict of file column name to DB column name, see result_dtypes
+        sep: Field separator
+        chunksize: Rows per chunk, returns an iterator of dataframes if set
+        engine: "pyarrow" or "c" to force a parser, None to choose
+
+    Return:
+        Dataframe, or a chunk iterator if chunksize is set
+    """
+    header = read_header(path, sep)
+    wanted = set(header) if columns is None else set(columns)
+    usecols = [c for c in header if c in wanted and c not in set(exclude)]
+    dtypes = result_dtypes(usecols, schema, rename)
+
+    skipped = len(header) - len(usecols)
+    if skipped:
+        print(f"Skipping {skipped} of {len(header)} result columns")
+
+    if engine is None:
+        engine = "pyarrow" if chunksize is None and _arrow_available() else "c"
+    if engine == "pyarrow":
+        if chunksize is not None:
+            raise ValueError("chunked reads need the c engine")
+        return _text_to_object(_read_arrow(path, sep, usecols, dtypes))
+
+    return _read_c(path, sep, usecols, dtypes, chunksize)
+
+def engines_agree(path, **options):
+    """
+    Checks that the pyarrow and C parsers read a result file identically
+
+    Params:
+        path: Path to the result TSV
+        options: Keyword arguments for read_results
+
+    Return:
+        True if both frames are equal, differences are printed otherwise
+    """
+    arrow = read_results(path, engine="pyarrow", **options)
+    c = read_results(path, engine="c", **options)
+    try:
+        pd.testing.assert_frame_equal(arrow, c)
+    except AssertionError as e:
+        print(f"pyarrow and c engines differ on {path}: {e}")
+        return False
+
+    return True
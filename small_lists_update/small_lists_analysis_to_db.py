@@ -1,8 +1,14 @@
 import sys
 import pyodbc
 import pandas as pd
+from pathlib import Path
 import small_lists_config as cfg
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.bulk_load import frame_to_rows, input_sizes_for_frame, insert_rows
+from common.cleaning import bool_to_text
+from common.results_reader import read_results
+
 def create_table(conn, table_name):
     """
     Creates a table in the dev DB
@@ -97,9 +103,7 @@ def data_cleaning(df):
     Returns:
         Dataframe with cleaned values
     """
-    mask = df.applymap(type) != bool
-    d = {True: 'true', False: 'false'}
-    df = df.where(mask, df.replace(d))
+    df = bool_to_text(df.copy())
 
     df = df[df['location_id'] != -1]
     df['location_status_id'] = 2
@@ -131,20 +135,25 @@ if __name__ == "__main__":
 
     # Load and clean the CSV
     print("Loading CSV data")
-    df = pd.read_csv(cfg.analysis_path, sep="\t")
+    df = read_results(cfg.analysis_path, columns=cfg.small_lists_columns)
     print("Cleaning CSV data")
     df = data_cleaning(df)
 
     # Insert the data
     print("Inserting data")
-    with connection:
-        cursor = connection.cursor()
-        updated_rows = 0
-
-        for index, row in df.iterrows():
-            sql_insert = f'INSERT INTO [dbo].[{table_name}]({",".join(cfg.small_lists_columns)}​​​​​​​​​​​​​​​​) VALUES ({",".join(["?"] * len(cfg.small_lists_columns))})'
-
-            cursor.execute(sql_insert, row.values.tolist())
-            updated_rows += 1
-
-    print(f"Finished. Rows updated: {updated_rows}")
\ No newline at end of file
+    columns = cfg.small_lists_columns
+    sql_insert = f'INSERT INTO [dbo].[{table_name}]({",".join(columns)}) VALUES ({",".join(["?"] * len(columns))})'
+    rows = frame_to_rows(df, columns)
+
+    updated_rows, failed = insert_rows(
+        connection,
+        sql_insert,
+        rows,
+        input_sizes=input_sizes_for_frame(df, columns),
+        batch_size=getattr(cfg, "insert_batch_size", 5000),
+        fallback=True,
+    )
+    for row, error in failed:
+        print(f"Failed location_id {row[1]}: {error}")
+
+    print(f"Finished. Rows updated: {updated_rows}")
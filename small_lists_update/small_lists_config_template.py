@@ -3,6 +3,9 @@ conn_string = ""
 analysis_path = r""
 list_number = 3
 
+# Rows per executemany batch when inserting analysis results
+insert_batch_size = 5000
+
 small_lists_columns = [
         "id",
         "location_id",
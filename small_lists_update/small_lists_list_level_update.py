@@ -1,7 +1,13 @@
+import sys
 import pyodbc
 import pandas as pd
+from pathlib import Path
 import small_lists_config as cfg
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.cleaning import bool_to_text
+from common.results_reader import read_results
+
 def data_cleaning(df):
     """
     Preps data for transfer to DB
@@ -12,9 +18,7 @@ def data_cleaning(df):
     Returns:
         Dataframe with cleaned values
     """
-    mask = df.applymap(type) != bool
-    d = {True: 'true', False: 'false'}
-    df = df.where(mask, df.replace(d))
+    df = bool_to_text(df.copy())
 
     df = df.rename(columns={"status_code": "status_id"})
 
@@ -44,7 +48,10 @@ if __name__ == "__main__":
 
     # Load and clean the CSV
     print("Loading CSV data")
-    df = pd.read_csv(cfg.analysis_path, sep="\t")
+    df = read_results(
+        cfg.analysis_path,
+        columns=cfg.small_lists_list_level_columns + ["location_id", "status_code"],
+    )
 
     print("Cleaning CSV data")
     df = data_cleaning(df)
@@ -1,8 +1,28 @@
+import sys
+import time
+import numpy as np
 import pandas as pd
 import sqlalchemy as sal
+from pathlib import Path
 import wdpa_config as cfg
 import name_conversion_dict as db_names
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.bulk_load import bulk_load, build_indexes, dbapi_connection, delete_keys, staged_load, swap_table
+from common.checkpoint import Checkpoint
+from common.merge_load import merge_load
+from common.cleaning import clean_for_schema
+from common.results_reader import read_results
+
+# Geotrellis output that is not loaded into the analysis table
+dropped_columns = [
+    "location_error",
+    "tree_cover_loss_arg_otbn_yearly",
+    "tree_cover_extent_primary_forest",
+    "protected_areas_by_category_area",
+    "landmark_by_category_area",
+]
+
 def cleanData(df):
     """
     Performs column name mapping operations
@@ -11,75 +31,179 @@ def cleanData(df):
         df  : Dataframe containing unaltered output from geotrellis
 
     Return:
-        Dataframe with columns matching Dec 2023 DB schema
+        Dataframe with columns matching Dec 2023 DB schema, bools as text
+        and "{}" in empty NVARCHAR columns
     """
 
-    # Drop extra cols
-    df = df.drop(
-        [
-            "location_error",
-            "tree_cover_loss_arg_otbn_yearly",
-            "tree_cover_extent_primary_forest",
-            "protected_areas_by_category_area",
-            "landmark_by_category_area",
-        ],
-        axis=1,
-    )
+    # Drop extra cols (already skipped when read with read_results)
+    df = df.drop(dropped_columns, axis=1, errors="ignore")
 
     # Rename cols
     df = df.rename(columns=db_names.col_names_dict)
 
-    # Add missing cols
-    for col in list(db_names.db_schema_dict.keys()):
-        if col not in df.columns:
-            df[col] = None
-
-    # Reorder columns
-    df = df[list(db_names.db_schema_dict.keys())]
+    # Add missing cols, reorder and convert values column by column
+    df = clean_for_schema(df, db_names.db_schema_dict)
 
     return df
 
-def boolConvert(df):
+def readResults(file_path, chunksize=None):
     """
-    Converts boolean values to text equivalents
+    Reads the processed Geotrellis output, skipping columns that are not loaded
 
-    Args:
-        df  : Dataframe with boolean values and columns matching DB schema
+    Params:
+        file_path: Path to the processed TSV
+        chunksize: Rows per chunk, returns a chunk iterator if set
 
     Return:
-        Dataframe with boolean values replaced with text equivalents
+        Dataframe or iterator of dataframes
     """
+    return read_results(
+        file_path,
+        columns=list(db_names.col_names_dict) + list(db_names.db_schema_dict),
+        exclude=dropped_columns,
+        schema=db_names.db_schema_dict,
+        rename=db_names.col_names_dict,
+        chunksize=chunksize,
+    )
 
-    mask = df.applymap(type) != bool
-    d = {True: "true", False: "false"}
-    df = df.where(mask, df.replace(d))
+def clearChunk(conn, table_name, location_ids):
+    """
+    Deletes the rows of a chunk that may have been partly loaded before a crash
 
-    return df
+    Params:
+        conn: SQLAlchemy connection
+        table_name: Table in dbo the chunk was appended to
+        location_ids: location_ids in the chunk
+    """
+    deleted = delete_keys(conn, table_name, "location_id", location_ids)
+    print(f"Cleared {deleted} partly loaded rows from {table_name}")
 
-def nvarcharConvert(df):
+def listLocationIds(conn, table_name="list-protectedAreas_import"):
     """
-    Converts null data in columns that will be NVARCHAR to default "{}"
+    Reads the sorted location_ids of the list table
 
-    Args:
-        df  : Dataframe with colummns matching DB schema
+    Params:
+        conn: SQLAlchemy connection
+        table_name: List table in dbo
 
     Return:
-        Dataframe with no "NULL" values in cols that will be NVARCHAR in the DB
+        Sorted int64 array
     """
+    raw = dbapi_connection(conn)
+    cursor = raw.cursor()
+    cursor.execute(f"SELECT [location_id] FROM [dbo].[{table_name}] ORDER BY [location_id]")
+
+    return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+def droppedLocationRows(list_ids, result_ids, list_id):
+    """
+    Builds default rows for list locations that have no Geotrellis result
+
+    Geotrellis drops some locations (parts of Greenland, small ocean
+    islands). They are found with one sorted set difference and get
+    null/default values, like the outer merge this replaces.
 
-    # Create a list of columns that contain NVARCHAR datatype
-    nvarchar_cols = [
-        k
-        for k, v in db_names.db_schema_dict.items()
-        if "NVARCHAR" in str(v)
-    ]
+    Params:
+        list_ids: location_ids of the list table
+        result_ids: location_ids in the results, may repeat or be NaN
+        list_id: Value of the id column, 4 for WDPA
 
-    # Replace None values with {} in NVARCHAR columns
-    for column in nvarchar_cols:
-        df[column].fillna("{}", inplace=True)
+    Return:
+        Cleaned dataframe with one row per dropped location
+    """
+    start = time.perf_counter()
+    result_ids = pd.Series(result_ids).dropna().to_numpy(dtype=np.int64)
+    missing = np.setdiff1d(list_ids, result_ids)
+
+    df = pd.DataFrame(
+        {
+            "id": np.full(len(missing), list_id, dtype=np.int64),
+            "location_id": missing,
+        }
+    )
+    df = clean_for_schema(df, db_names.db_schema_dict)
+    print(f"Backfilled {len(missing)} dropped locations in {time.perf_counter() - start:.2f}s")
 
     return df
 
+def streamToDb(conn, file_path, table_name, checkpoint, chunk_size=100000, swap=False, columnstore=False, batch_size=20000, workers=1, list_id=None):
+    """
+    Loads the result file chunk by chunk so memory stays flat
+
+    Each chunk is cleaned and appended to a heap as soon as it is read. The
+    checkpoint records finished chunk numbers, so a resumed run skips them
+    and clears the rows of the chunk that was interrupted before reloading
+    it. Indexes are built, and the table swapped live, after the last chunk.
+
+    Params:
+        conn: SQLAlchemy connection
+        file_path: Path to the processed TSV
+        table_name: Target table in dbo
+        checkpoint: Checkpoint of finished chunk numbers
+        chunk_size: Rows per chunk
+        swap: Load into {table_name}_staging and swap it in, see staged_load
+        columnstore: Use a clustered columnstore index, see build_indexes
+        batch_size: Rows per executemany call
+        workers: Concurrent connections, see bulk_load
+        list_id: Backfill list locations missing from the results with
+            this id after the last chunk, see droppedLocationRows. None skips it
+
+    Return:
+        Number of rows inserted by this run
+    """
+    load_name = f"{table_name}_staging" if swap else table_name
+    fresh = not checkpoint.completed
+    resumed = resumed_run = not fresh
+    inserted = 0
+    result_ids = []
+
+    for number, chunk in enumerate(readResults(file_path, chunksize=chunk_size)):
+        # ids of skipped chunks are kept too, the backfill needs all of them
+        result_ids.append(chunk["location_id"].to_numpy())
+        if checkpoint.is_done(number):
+            continue
+
+        chunk = cleanData(chunk)
+        if resumed:
+            clearChunk(conn, load_name, chunk["location_id"].dropna().unique())
+            resumed = False
+
+        inserted += bulk_load(
+            conn,
+            load_name,
+            chunk,
+            db_names.db_schema_dict,
+            if_exists="replace" if fresh else "append",
+            batch_size=batch_size,
+            workers=workers,
+        )
+        fresh = False
+        checkpoint.mark_done(number)
+        print(f"Chunk {number} done, {inserted} rows loaded this run")
+
+    if list_id is not None and not checkpoint.is_done("backfill"):
+        backfill = droppedLocationRows(listLocationIds(conn), np.concatenate(result_ids), list_id)
+        if resumed_run:
+            clearChunk(conn, load_name, backfill["location_id"])
+        inserted += bulk_load(
+            conn,
+            load_name,
+            backfill,
+            db_names.db_schema_dict,
+            if_exists="replace" if fresh else "append",
+            batch_size=batch_size,
+        )
+        checkpoint.mark_done("backfill")
+
+    if not checkpoint.is_done("indexed"):
+        build_indexes(conn, load_name, index_name=table_name, columnstore=columnstore)
+        checkpoint.mark_done("indexed")
+    if swap and not checkpoint.is_done("swapped"):
+        swap_table(conn, load_name, table_name)
+        checkpoint.mark_done("swapped")
+
+    return inserted
+
 if __name__ == "__main__":
     """This is executed when run from the command line"""
 
@@ -89,41 +213,93 @@ if __name__ == "__main__":
     conn = engine.connect()
     print("Connected to DB")
 
-    # # Create df with all original location ids from db
-    # loc_id_sql = "SELECT [location_id] FROM [gfwpro].[dbo].[list-protectedAreas_import]"
-    # loc_id_df = pd.read_sql(loc_id_sql, conn)
-    # print("Retrieved location_id data from database")
+    swap_into = getattr(cfg, "swap_into", None)
+    merge_into = getattr(cfg, "merge_into", None)
+    chunk_size = getattr(cfg, "stream_chunk_size", None)
+    # re-add locations Geotrellis dropped, None turns it off
+    list_id = getattr(cfg, "backfill_list_id", 4)
+
+    # delta mode: the results cover only the locations an incremental prep
+    # diced, deletions come from its deleted_locations.txt
+    delta_deletions = getattr(cfg, "delta_deletions", None)
+    deleted_keys = None
+    if delta_deletions:
+        if not merge_into:
+            raise ValueError("delta_deletions needs merge_into, a delta cannot replace a table")
+        deleted_keys = pd.read_csv(delta_deletions, sep="\t")["location_id"]
+        # every location missing from a delta is unchanged, not dropped
+        list_id = None
+        print(f"Delta load, {len(deleted_keys)} deleted locations")
+
+    if chunk_size and not merge_into:
+        # constant memory, nothing is held beyond one chunk
+        # chunk numbers only mean something for the same file and chunk size
+        source_stat = Path(cfg.processed_csv).stat()
+        checkpoint = Checkpoint(
+            getattr(cfg, "stream_checkpoint_path", Path(cfg.out_dir) / "analysis_load_checkpoint.json"),
+            resume=getattr(cfg, "resume", False),
+            source={
+                "file": str(Path(cfg.processed_csv).resolve()),
+                "size": source_stat.st_size,
+                "mtime_ns": source_stat.st_mtime_ns,
+                "chunk_size": chunk_size,
+                "table": swap_into or "analysis-protectedAreas_import",
+            },
+        )
+        streamToDb(
+            conn,
+            cfg.processed_csv,
+            swap_into or "analysis-protectedAreas_import",
+            checkpoint,
+            chunk_size=chunk_size,
+            swap=bool(swap_into),
+            columnstore=getattr(cfg, "columnstore", False),
+            batch_size=getattr(cfg, "load_batch_size", 20000),
+            workers=getattr(cfg, "load_workers", 1),
+            list_id=list_id,
+        )
+        print("Done")
+        sys.exit(0)
 
     # Read csv to df
     file_path = cfg.processed_csv
-    input_df = pd.read_csv(file_path, sep="\t")
+    input_df = readResults(file_path)
     print("Read input data")
 
-    # # Merge dataframes
-    # merged_df = pd.merge(loc_id_df, input_df, on="location_id", how="outer")
-    # print("Created merged dataframe")
-    merged_df = input_df
-
     # Clean input_df
-    merged_df = cleanData(merged_df)
+    merged_df = cleanData(input_df)
     print("Cleaned dataframe columns")
 
-    # Replace boolean values with string
-    merged_df = boolConvert(merged_df)
-    print("Converted bool values")
-
-    # Replace null nvarchar values with {}
-    merged_df = nvarcharConvert(merged_df)
-    print("Converted nvarchar values")
+    # Add default rows for locations dropped by Geotrellis
+    if list_id is not None:
+        backfill = droppedLocationRows(listLocationIds(conn), merged_df["location_id"], list_id)
+        merged_df = pd.concat([merged_df, backfill], ignore_index=True)
 
     # Save to database
     print("Saving dataframe to database")
-    merged_df.to_sql(
-        "analysis-protectedAreas_import",
-        conn,
-        index=False,
-        if_exists="replace",
-        dtype=db_names.db_schema_dict,
-    )
+    # swap_into names the live table to replace atomically, otherwise the
+    # data lands in the _import table for validation as before
+    if merge_into:
+        # incremental refresh, only changed rows are written
+        merge_load(
+            conn,
+            merge_into,
+            merged_df,
+            db_names.db_schema_dict,
+            batch_size=getattr(cfg, "load_batch_size", 20000),
+            workers=getattr(cfg, "load_workers", 1),
+            deleted_keys=deleted_keys,
+        )
+    else:
+        staged_load(
+            conn,
+            swap_into or "analysis-protectedAreas_import",
+            merged_df,
+            db_names.db_schema_dict,
+            swap=bool(swap_into),
+            columnstore=getattr(cfg, "columnstore", False),
+            batch_size=getattr(cfg, "load_batch_size", 20000),
+            workers=getattr(cfg, "load_workers", 1),
+        )
 
     print("Done")
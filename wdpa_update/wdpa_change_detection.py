@@ -0,0 +1,195 @@
+import hashlib
+import shapely
+import numpy as np
+import pandas as pd
+
+# Attributes that feed the list and analysis tables. A change to any of them,
+# or to the geometry, marks a protected area as changed.
+fingerprint_columns = [
+    "NAME",
+    "GIS_AREA",
+    "IUCN_CAT",
+    "DESIG_TYPE",
+    "DESIG_ENG",
+    "name_0",
+    "name_1",
+    "name_2",
+    "gadmid",
+]
+
+def fingerprint(gdf):
+    """
+    Computes a stable fingerprint per row from its 2D WKB and attributes
+
+    Params:
+        gdf: Geodataframe read from the poly_gadm layer
+
+    Return:
+        Series of hex digests with the same index as gdf
+    """
+    columns = [c for c in fingerprint_columns if c in gdf.columns]
+    wkbs = shapely.to_wkb(gdf.geometry.values, output_dimension=2)
+    attrs = zip(*[gdf[c].astype(str).tolist() for c in columns])
+
+    digests = [
+        hashlib.sha1((w or b"") + "\x1f".join(a).encode()).hexdigest()
+        for w, a in zip(wkbs, attrs)
+    ]
+
+    return pd.Series(digests, index=gdf.index, dtype=object)
+
+def changedRows(gdf, fingerprints, previous):
+    """
+    Finds rows that are new or changed since the previous release
+
+    Rows are matched on location_id, which LocationIds keeps stable, so a
+    new id always counts as a change and is diced.
+
+    Params:
+        gdf: Geodataframe with a location_id column from LocationIds
+        fingerprints: Output of fingerprint for gdf
+        previous: Dataframe of the previous release's fingerprints
+
+    Return:
+        Boolean mask over gdf
+    """
+    previous_by_id = previous.drop_duplicates("location_id").set_index("location_id")["fingerprint"]
+
+    return fingerprints.values != gdf["location_id"].map(previous_by_id).values
+
+class LocationIds:
+    """
+    Keeps each protected area's location_id stable between releases
+
+    Rows are keyed on WDPA_PID plus the occurrence of that PID (first,
+    second, ... row with the PID), so a PID that repeats within a release
+    keeps one id per occurrence too. Keys seen in the previous release keep
+    their location_id. New keys get ids above the previous maximum, so they
+    never collide with an id that is still in use.
+
+    Params:
+        previous: Dataframe of the previous release's fingerprints, in
+            layer order
+    """
+
+    def __init__(self, previous):
+        pids = previous["WDPA_PID"].astype(str)
+        occurrence = pids.groupby(pids).cumcount()
+        self.previous = pd.Series(
+            previous["location_id"].to_numpy(), index=pd.MultiIndex.from_arrays([pids, occurrence])
+        )
+        self.next_id = int(previous["location_id"].max()) + 1 if len(previous) else 0
+        self.counts = pd.Series(dtype="int64")
+
+    def assign(self, pids):
+        """
+        Assigns location_ids to one window of PIDs
+
+        Windows must be passed in layer order.
+
+        Params:
+            pids: Series of WDPA_PIDs
+
+        Return:
+            int64 array of location_ids, in the order of pids
+        """
+        pids = pids.astype(str).reset_index(drop=True)
+        occurrence = pids.groupby(pids).cumcount() + pids.map(self.counts).fillna(0).astype("int64")
+        keys = pd.MultiIndex.from_arrays([pids, occurrence])
+        ids = self.previous.reindex(keys).to_numpy(dtype=float, copy=True)
+
+        new = np.isnan(ids)
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+
+        self.next_id += int(new.sum())
+        self.counts = self.counts.add(pids.value_counts(), fill_value=0).astype("int64")
+
+        return ids.astype(np.int64)
+
+def loadFingerprints(path):
+    """
+    Loads fingerprints saved by a previous run
+
+    Params:
+        path: Path to the fingerprint file
+
+    Return:
+        Dataframe with WDPA_PID, location_id and fingerprint columns
+    """
+    return pd.read_csv(path, sep="\t", dtype={"WDPA_PID": str, "fingerprint": str})
+
+def saveFingerprints(path, fingerprints):
+    """
+    Saves fingerprints for the next release to compare against
+
+    Params:
+        path: Path to the fingerprint file
+        fingerprints: Dataframe with WDPA_PID, location_id and fingerprint columns
+    """
+    fingerprints.to_csv(path, sep="\t", index=False)
+
+def saveLocationIds(path, fingerprints):
+    """
+    Saves the WDPA_PID -> location_id map of this release
+
+    Params:
+        path: Path to the map file
+        fingerprints: Dataframe with WDPA_PID and location_id columns
+    """
+    fingerprints[["WDPA_PID", "location_id"]].to_csv(path, sep="\t", index=False)
+
+def loadLocationIds(path):
+    """
+    Loads a WDPA_PID -> location_id map saved by saveLocationIds
+
+    Params:
+        path: Path to the map file
+
+    Return:
+        Dataframe with WDPA_PID and location_id columns, one row per layer row
+    """
+    return pd.read_csv(path, sep="\t", dtype={"WDPA_PID": str})
+
+def applyLocationIds(gdf, start, location_ids):
+    """
+    Sets location_id on a slice of the layer from the map of this release
+
+    The map has one row per layer row, so the slice starting at row start
+    takes the map rows from start. PIDs are compared to catch a map written
+    for a different FGDB.
+
+    Params:
+        gdf: Slice of the layer, read with rows=slice(start, ...)
+        start: Layer row of the first row of gdf
+        location_ids: Output of loadLocationIds
+
+    Return:
+        gdf with location_id replaced
+    """
+    mapped = location_ids.iloc[start : start + len(gdf)]
+    if len(mapped) != len(gdf) or (
+        mapped["WDPA_PID"].to_numpy() != gdf["WDPA_PID"].astype(str).to_numpy()
+    ).any():
+        raise ValueError(f"location_id map does not match layer rows {start} to {start + len(gdf)}")
+
+    gdf = gdf.copy()
+    gdf["location_id"] = mapped["location_id"].to_numpy()
+
+    return gdf
+
+def deletedLocations(current, previous):
+    """
+    Finds protected areas in the previous release that are gone from this one
+
+    Params:
+        current: Dataframe of this release's fingerprints
+        previous: Dataframe of the previous release's fingerprints
+
+    Return:
+        Dataframe with the WDPA_PID and previous location_id of each deletion
+    """
+    # location_ids are stable (see LocationIds), so any previous id that is
+    # not reused is gone, including extra rows of a PID that still exists
+    deleted = previous[~previous["location_id"].isin(current["location_id"])]
+
+    return deleted[["WDPA_PID", "location_id"]]
@@ -0,0 +1,92 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import name_conversion_dict as db_names
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common.cleaning import clean_for_schema, schema_columns
+
+def legacyClean(df, schema):
+    """
+    Reorder, boolConvert and nvarcharConvert as they were before common.cleaning
+    """
+    for col in list(schema.keys()):
+        if col not in df.columns:
+            df[col] = None
+    df = df[list(schema.keys())]
+
+    # applymap was renamed to map in pandas 2.1 and removed in 3.0
+    elementwise = df.map if hasattr(df, "map") else df.applymap
+    mask = elementwise(type) != bool
+    d = {True: "true", False: "false"}
+    df = df.where(mask, df.replace(d))
+
+    for column in schema_columns(schema, "NVARCHAR"):
+        df[column] = df[column].fillna("{}")
+
+    return df
+
+def syntheticFrame(schema, rows, seed=0):
+    """
+    Builds a results-like frame: numbers in DECIMAL/INTEGER columns, JSON-ish
+    text with nulls in NVARCHAR columns and bools in the *_presence columns
+
+    Params:
+        schema: Dict of column name to SQLAlchemy type
+        rows: Number of rows
+
+    Return:
+        Dataframe with every schema column but the last, in shuffled order
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for column, sql_type in schema.items():
+        if column.endswith("_presence"):
+            data[column] = rng.random(rows) < 0.5
+        elif "NVARCHAR" in str(sql_type):
+            text = np.array(['{"2001":1.5}', None], dtype=object)
+            data[column] = text[(rng.random(rows) < 0.1).astype(int)]
+        else:
+            data[column] = rng.random(rows) * 1000
+
+    columns = list(data)[:-1]
+    rng.shuffle(columns)
+
+    return pd.DataFrame({c: data[c] for c in columns})
+
+def main(rows=300000):
+    """
+    Times the legacy cleaning against clean_for_schema and checks they agree
+
+    Params:
+        rows: Rows in the synthetic frame
+    """
+    schema = db_names.db_schema_dict
+    df = syntheticFrame(schema, rows)
+    print(f"{len(df)} rows x {len(df.columns)} columns")
+
+    start = time.perf_counter()
+    legacy = legacyClean(df.copy(), schema)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaned = clean_for_schema(df, schema)
+    vectorized_time = time.perf_counter() - start
+
+    text_cols = schema_columns(schema, "NVARCHAR")
+    same = legacy[text_cols].astype(str).equals(cleaned[text_cols].astype(str))
+
+    print(f"legacy: {legacy_time:.2f} s")
+    print(f"clean_for_schema: {vectorized_time:.2f} s ({legacy_time / vectorized_time:.0f}x)")
+    print(f"NVARCHAR output identical: {same}")
+
+    return
+
+if __name__ == "__main__":
+    """This is executed when run from the command line"""
+
+    main()
+
+    print("done")
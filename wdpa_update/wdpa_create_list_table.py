@@ -1,18 +1,79 @@
+import sys
+import queue
 import pyodbc
+import threading
+import shapely
 import pandas as pd
 import geopandas as gpd
+from pathlib import Path
 import wdpa_config as cfg
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import fgdb
+from common.checkpoint import Checkpoint
+from common.bulk_load import bisect_insert, delete_keys
+from common.geometry_repair import repair_invalid, print_report
+from wdpa_geostore_lookup import loadGeostoreLookup, joinGeostore
+import wdpa_change_detection as changes
+
+# Serializes appends to the reject file between pipeline inserters
+_rejects_lock = threading.Lock()
+
+# Parsed once per run on first use, see geostoreLookup
+_geostore_lookup = None
+
+def geostoreLookup():
+    """
+    Returns the wdpa_pid -> gfw_geostore_id lookup, loading it on first use
+    """
+    global _geostore_lookup
+    if _geostore_lookup is None:
+        _geostore_lookup = loadGeostoreLookup(
+            cfg.json_path, getattr(cfg, "geostore_cache_dir", cfg.out_dir)
+        )
+
+    return _geostore_lookup
+
 def join_globalid(gdf):
     """
     Join globalid data
     """
-    df = pd.read_json(cfg.json_path)
-    df_expanded = pd.json_normalize(df["data"])
+    return joinGeostore(gdf, geostoreLookup())
 
-    gdf = gdf.merge(df_expanded, how="left", left_on="WDPA_PID", right_on="wdpa_pid")
+# Loaded once per run on first use, see locationIds
+_location_ids = None
 
-    return gdf
+def locationIds():
+    """
+    Returns the location_id map written by wdpa_prep_for_analysis, loading it
+    on first use, or None if this release has no map
+    """
+    global _location_ids
+    if _location_ids is None:
+        path = Path(
+            getattr(cfg, "location_ids_path", Path(cfg.out_dir) / "wdpa_location_ids.txt")
+        )
+        if not path.exists():
+            print(f"No location_id map at {path}, using location_id from the FGDB")
+            _location_ids = False
+        else:
+            _location_ids = changes.loadLocationIds(path)
+
+    return _location_ids if _location_ids is not False else None
+
+def join_location_ids(gdf, start):
+    """
+    Sets location_id to the id the analysis table uses for these rows
+
+    Params:
+        gdf: Slice of the layer starting at row start
+        start: Layer row of the first row of gdf
+    """
+    location_ids = locationIds()
+    if location_ids is None:
+        return gdf
+
+    return changes.applyLocationIds(gdf, start, location_ids)
 
 def wdpa_renameColumns(gdf):
     """
@@ -45,13 +106,56 @@ def wdpa_renameColumns(gdf):
 
     return gdf
 
-def insert_geometry_WDPA(gdf, connection):
+def writeRejects(rejected):
     """
-    Large list processing - insert new locations into locations table
+    Appends rejected locations and their database errors to the reject file
+
+    Params:
+        rejected: List of (id, error text) tuples
+    """
+    reject_path = Path(getattr(cfg, "reject_path", Path(cfg.out_dir) / "list_rejects.txt"))
+    with _rejects_lock:
+        pd.DataFrame(rejected, columns=["id", "error"]).to_csv(
+            reject_path, sep="\t", index=False, mode="a", header=not reject_path.exists()
+        )
+
+def serializeGeometry(gdf, geometry_format="wkt"):
     """
+    Serializes 2D geometry for transfer to SQL Server
 
+    Params:
+        gdf: Geodataframe to serialize
+        geometry_format: "wkt" text for STGeomFromText or "wkb" binary for
+            STGeomFromWKB, which is cheaper to build and smaller on the wire
+
+    Return:
+        (values, SQL expression for the parameter, pyodbc input size) tuple
+    """
+    if geometry_format == "wkb":
+        values = shapely.to_wkb(gdf.geometry.values, output_dimension=2)
+        return values, "geometry::STGeomFromWKB(?, 4326)", (pyodbc.SQL_VARBINARY, 0, 0)
+    if geometry_format == "wkt":
+        values = gdf.geometry.to_wkt(output_dimension=2)
+        return values, "geometry::STGeomFromText(?, 4326)", (pyodbc.SQL_WVARCHAR, 0, 0)
+
+    raise ValueError(f"Unknown geometry format {geometry_format}")
+
+def prepareLocations(gdf, geometry_format="wkt"):
+    """
+    Repairs and serializes a batch for insertion into the locations table
+
+    This is the CPU side of insert_geometry_WDPA, kept separate so the
+    pipelined load can run it while another batch is being inserted.
+
+    Params:
+        gdf: Renamed geodataframe, see wdpa_renameColumns
+        geometry_format: "wkt" or "wkb", see serializeGeometry
+
+    Return:
+        Dict with the INSERT sql, parameter rows, input sizes and the
+        position of the id column in each row
+    """
     table_name = "list-protectedAreas_import"
-    analysis_table_name = "analysis-protectedAreas_import"
     columns = [
         "Location Name",
         "Latitude",
@@ -73,38 +177,89 @@ def insert_geometry_WDPA(gdf, connection):
         "Geometry",
     ]
 
-    locations_objectid_list = gdf["id"].tolist()
+    # repair only invalid geometries so SQL Server does not reject the batch
+    repaired, report = repair_invalid(gdf.geometry)
+    gdf[gdf.geometry.name] = repaired
+    if report["repaired"]:
+        print_report(report)
+
+    # convert geometry to wkt or wkb (2D)
+    gdf["Geometry"], geometry_sql, geometry_size = serializeGeometry(gdf, geometry_format)
+
+    # select columns to keep (Geometry should be last in the list)
+    common_columns = list(
+        gdf.columns.intersection(set(columns))
+    )  # selects columns that are in the list provided
+    common_columns.sort(
+        key="Geometry".__eq__
+    )  # https://stackoverflow.com/questions/20320702/how-do-i-move-an-element-in-my-list-to-the-end-in-python
+    new_locations = list(gdf[common_columns].itertuples(index=False, name=None))
+
+    column_name_string = ",".join([f'"{x}"' for x in common_columns])
+    value_marks = ",".join(
+        [f"?" for x in common_columns[:-1]]
+    )  # ? per attribute minus 1 for geometry (special case)
+
+    value_marks = value_marks + "," + geometry_sql
+    sql = f"INSERT into [dbo].[{table_name}] ({column_name_string}) VALUES ({value_marks})"
+    inputSizes = [None for c in common_columns[:-1]]
+    inputSizes.append(geometry_size)
+
+    return {
+        "table": table_name,
+        "sql": sql,
+        "rows": new_locations,
+        "input_sizes": inputSizes,
+        "id_index": common_columns.index("id"),
+    }
+
+def insertLocations(prepared, connection, clear=False):
+    """
+    Inserts a prepared batch, bisecting failures down to the bad rows
+
+    Bisection commits each half on its own, so a run that dies part way
+    leaves some of the batch loaded without marking it done. On resume,
+    clear deletes the batch's ids first so they are not inserted twice.
 
-    gdf.geometry = gdf.buffer(0)
+    Params:
+        prepared: Output of prepareLocations
+        connection: pyodbc connection
+        clear: Delete rows with the batch's ids before inserting
+
+    Return:
+        List of location ids that were rejected
+    """
+    if clear:
+        ids = [row[prepared["id_index"]] for row in prepared["rows"]]
+        deleted = delete_keys(connection, prepared["table"], "id", ids)
+        if deleted:
+            print(f"Cleared {deleted} partly loaded locations")
+
+    # a failing batch is split in half until only the bad rows are left
+    inserted, rejected = bisect_insert(
+        connection, prepared["sql"], prepared["rows"], prepared["input_sizes"]
+    )
+
+    if rejected:
+        rejected = [(row[prepared["id_index"]], error) for row, error in rejected]
+        writeRejects(rejected)
+        print(f"Rejected {len(rejected)} of {len(prepared['rows'])} locations")
+
+    return [location_id for location_id, error in rejected]
+
+def insert_geometry_WDPA(gdf, connection, geometry_format="wkt", clear=False):
+    """
+    Large list processing - insert new locations into locations table
+
+    geometry_format selects WKT text or WKB binary transfer, see
+    serializeGeometry. clear is passed to insertLocations. Connection
+    errors are raised so the batch is not marked done
+    """
+    analysis_table_name = "analysis-protectedAreas_import"
+    locations_objectid_list = gdf["id"].tolist()
 
     try:
-        gdf["Geometry"] = gdf.geometry.to_wkt(
-            output_dimension=2
-        )  # convert geometry to wkt (2D)
-
-        # select columns to keep (Geometry should be last in the list)
-        common_columns = list(
-            gdf.columns.intersection(set(columns))
-        )  # selects columns that are in the list provided
-        common_columns.sort(
-            key="Geometry".__eq__
-        )  # https://stackoverflow.com/questions/20320702/how-do-i-move-an-element-in-my-list-to-the-end-in-python
-        new_locations = list(gdf[common_columns].itertuples(index=False, name=None))
-
-        with connection:
-            cursor = connection.cursor()
-            cursor.fast_executemany = True
-            column_name_string = ",".join([f'"{x}"' for x in common_columns])
-            value_marks = ",".join(
-                [f"?" for x in common_columns[:-1]]
-            )  # ? per attribute minus 1 for geometry (special case)
-
-            value_marks = value_marks + "," + "geometry::STGeomFromText(?, 4326)"
-            sql = f"INSERT into [dbo].[{table_name}] ({column_name_string}) VALUES ({value_marks})"
-            inputSizes = [None for c in common_columns[:-1]]
-            inputSizes.append((pyodbc.SQL_WVARCHAR, 0, 0))
-            cursor.setinputsizes(inputSizes)
-            cursor.executemany(sql, new_locations)
+        failed = insertLocations(prepareLocations(gdf, geometry_format), connection, clear)
 
         # # insert location_ids into analysis table
         # gdf["location_status_id"] = 1
@@ -121,37 +276,204 @@ def insert_geometry_WDPA(gdf, connection):
 
         # print(f"Adding {len(t)} empty rows to {analysis_table_name} finished")
 
-        return []
+        return failed
+    except (pyodbc.OperationalError, pyodbc.InterfaceError):
+        raise
     except Exception as e:
         print(e)
         return locations_objectid_list  # return list of failed locations
 
-def loadGFWList(path, start, end, connection):
+def loadGFWList(path, start, end, connection, geometry_format="wkt", clear=False):
     """
     Loads and preps the geodataframe
     """
     gdf = gpd.read_file(path, driver="FileGDB", layer=0, rows=slice(start, end))
+    gdf = join_location_ids(gdf, start)
     gdf = join_globalid(gdf)
     gdf = wdpa_renameColumns(gdf)
-    e = insert_geometry_WDPA(gdf, connection)
+    e = insert_geometry_WDPA(gdf, connection, geometry_format, clear)
 
     return e
 
+def batchKey(start, end):
+    """
+    Checkpoint name of a batch
+    """
+    return f"{start}:{end}"
+
+def loadGFWListPipelined(
+    path,
+    batches,
+    connect,
+    checkpoint,
+    geometry_format="wkt",
+    readers=2,
+    inserters=1,
+    queue_size=4,
+    clear=False,
+):
+    """
+    Loads batches with reading, transforming and inserting running concurrently
+
+    Reader threads pull FGDB slices, one transform thread joins, renames,
+    repairs and serializes them, and inserter threads each write over their
+    own connection. Bounded queues between the stages keep file I/O,
+    geometry work and DB round trips busy at the same time without reading
+    ahead unboundedly.
+
+    Params:
+        path: Path to the WDPA FGDB
+        batches: List of (start, end) row ranges to load
+        connect: Callable returning a new pyodbc connection
+        checkpoint: Checkpoint that completed batches are recorded in
+        geometry_format: "wkt" or "wkb", see serializeGeometry
+        readers: Number of reader threads
+        inserters: Number of inserter threads and connections
+        queue_size: Batches allowed to wait between two stages
+        clear: Delete each batch's ids before inserting, see insertLocations
+    """
+    pending = queue.Queue()
+    for batch in batches:
+        pending.put(batch)
+    read_queue = queue.Queue(maxsize=queue_size)
+    insert_queue = queue.Queue(maxsize=queue_size)
+    # inserters still reading insert_queue, the transformer sends one sentinel each
+    alive = inserters
+    alive_lock = threading.Lock()
+
+    def reader():
+        while True:
+            try:
+                start, end = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                gdf = gpd.read_file(path, driver="FileGDB", layer=0, rows=slice(start, end))
+                read_queue.put(((start, end), gdf))
+            except Exception as e:
+                print(f"Reading {start} to {end} failed: {e}")
+
+    def transformer():
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            (start, end), gdf = item
+            try:
+                gdf = wdpa_renameColumns(join_globalid(join_location_ids(gdf, start)))
+                insert_queue.put(((start, end), prepareLocations(gdf, geometry_format)))
+            except Exception as e:
+                # left undone, like the sequential load, so resume retries it
+                print(f"Preparing {start} to {end} failed: {e}")
+
+        # one sentinel per inserter still reading, see inserter. One that exits
+        # after this only leaves an unread sentinel behind
+        with alive_lock:
+            remaining = alive
+        for _ in range(remaining):
+            insert_queue.put(None)
+
+    def inserter():
+        nonlocal alive
+        try:
+            connection = connect()
+        except Exception as e:
+            connection = None
+            with alive_lock:
+                if alive > 1:
+                    # another inserter takes the batches
+                    alive -= 1
+                    print(f"Inserter could not connect, exiting: {e}")
+                    return
+            # the last inserter keeps draining so the upstream stages never
+            # block on a full queue, its batches are left for resume
+            print(f"Inserter could not connect, its batches are left for resume: {e}")
+
+        try:
+            while True:
+                item = insert_queue.get()
+                if item is None:
+                    return
+                if connection is None:
+                    continue
+                (start, end), prepared = item
+                try:
+                    failed = insertLocations(prepared, connection, clear)
+                except Exception as e:
+                    # may be partly loaded, left undone so resume clears and retries it
+                    print(f"Inserting {start} to {end} failed: {e}")
+                    continue
+                print(f"Loaded {start} to {end}, failed {len(failed)}")
+                checkpoint.mark_done(batchKey(start, end), failed)
+        finally:
+            if connection is not None:
+                connection.close()
+
+    reader_threads = [threading.Thread(target=reader) for _ in range(readers)]
+    transform_thread = threading.Thread(target=transformer)
+    inserter_threads = [threading.Thread(target=inserter) for _ in range(inserters)]
+
+    for t in reader_threads + [transform_thread] + inserter_threads:
+        t.start()
+    for t in reader_threads:
+        t.join()
+    read_queue.put(None)
+    transform_thread.join()
+    for t in inserter_threads:
+        t.join()
+
 if __name__ == "__main__":
     """This is executed when run from the command line"""
-    print("Connecting to DB")
-    connection = pyodbc.connect(cfg.conn_string)
-    print("Connected to DB")
-
     # Iteratively load data to DB
-    failed = []
     batch_size = 1000
-    for i in range(0, 300000, batch_size):
-        print(f"Loading {i} to {i+batch_size}")
-        try:
-            e = loadGFWList(cfg.fgdb_path, i, i + batch_size, connection)
-            if len(e) > 0:
-                failed.extend(e)
-                print(f"Failed {len(e)}")
-        except Exception as e:
-            print(e)
\ No newline at end of file
+    geometry_format = getattr(cfg, "geometry_format", "wkt")
+    resume = getattr(cfg, "resume", False)
+    total = fgdb.feature_count(cfg.fgdb_path, 0)
+    print(f"{total} features to load")
+
+    # Completed batches and failed ids survive a crash, resume skips the done
+    # batches. The manifest is tied to this FGDB so a stale one is rejected.
+    # Batches not marked done may be partly loaded, resume clears them first
+    checkpoint = Checkpoint(
+        getattr(cfg, "checkpoint_path", Path(cfg.out_dir) / "list_load_checkpoint.json"),
+        resume=resume,
+        source={
+            "fgdb": str(Path(cfg.fgdb_path).resolve()),
+            "features": total,
+            "batch_size": batch_size,
+        },
+    )
+
+    batches = [
+        (i, i + batch_size)
+        for i in range(0, total, batch_size)
+        if not checkpoint.is_done(batchKey(i, i + batch_size))
+    ]
+
+    if getattr(cfg, "pipeline", False):
+        loadGFWListPipelined(
+            cfg.fgdb_path,
+            batches,
+            lambda: pyodbc.connect(cfg.conn_string),
+            checkpoint,
+            geometry_format,
+            readers=getattr(cfg, "pipeline_readers", 2),
+            inserters=getattr(cfg, "pipeline_inserters", 1),
+            clear=resume,
+        )
+    else:
+        print("Connecting to DB")
+        connection = pyodbc.connect(cfg.conn_string)
+        print("Connected to DB")
+
+        for i, end in batches:
+            print(f"Loading {i} to {end}")
+            try:
+                e = loadGFWList(cfg.fgdb_path, i, end, connection, geometry_format, resume)
+                if len(e) > 0:
+                    print(f"Failed {len(e)}")
+                checkpoint.mark_done(batchKey(i, end), e)
+            except Exception as e:
+                print(e)
+
+    print(f"Done. {len(checkpoint.failed)} failed locations recorded in {checkpoint.path}")
@@ -0,0 +1,95 @@
+import sys
+import time
+import shapely
+import geopandas as gpd
+from pathlib import Path
+import wdpa_config as cfg
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import dicing
+
+def overlayDice(gdf, degrees=1):
+    """
+    Dices with the original global overlay, used as the reference output
+
+    Params:
+        gdf: Geodataframe of polygons
+        degrees: Size of grid
+
+    Return:
+        Diced geodataframe
+    """
+    grid = dicing.createGrid(degrees=degrees)
+    return gpd.overlay(gdf, grid, how="intersection", keep_geom_type=True, make_valid=True)
+
+def compare(reference, candidate):
+    """
+    Compares two diced dataframes piece by piece
+
+    Params:
+        reference: Output of overlayDice
+        candidate: Output of dicing.dice
+
+    Return:
+        Dict with row counts, key mismatches and the largest area difference
+    """
+    ref = reference.set_index(["location_id", "grid"]).sort_index()
+    cand = candidate.set_index(["location_id", "grid"]).sort_index()
+    common = ref.index.intersection(cand.index)
+
+    # planar areas in degrees, only the ratio matters
+    ref_geoms = ref.loc[common].geometry.values
+    cand_geoms = cand.loc[common].geometry.values
+    diff = shapely.area(shapely.symmetric_difference(ref_geoms, cand_geoms)) / shapely.area(ref_geoms)
+
+    return {
+        "reference_rows": len(ref),
+        "candidate_rows": len(cand),
+        "missing_rows": len(ref.index.difference(cand.index)),
+        "extra_rows": len(cand.index.difference(ref.index)),
+        "max_relative_area_diff": float(diff.max()) if len(diff) else 0.0,
+    }
+
+def benchmark(gdf):
+    """
+    Times the overlay against both dicing kernels and compares their output
+
+    Params:
+        gdf: Geodataframe with location_id and geometry columns in EPSG:4326
+    """
+    # build the grid once so setup is not part of the timings
+    dicing.createGrid(degrees=1)
+
+    start = time.perf_counter()
+    reference = overlayDice(gdf)
+    print(f"overlay: {time.perf_counter() - start:.2f}s")
+
+    for method in ["intersection", "rect"]:
+        start = time.perf_counter()
+        candidate = dicing.dice(gdf, degrees=1, method=method)
+        print(f"dice ({method}): {time.perf_counter() - start:.2f}s")
+        print(compare(reference, candidate))
+
+def main(path_to_fgdb, rows=5000):
+    """
+    Times the overlay against both dicing kernels on a sample of WDPA polygons
+
+    Params:
+        path_to_fgdb: Path to FGDB with GADMID attached
+        rows: Number of polygons to sample from the start of the layer
+    """
+    print(f"loading {rows} rows from {path_to_fgdb}")
+    gdf = gpd.read_file(
+        path_to_fgdb, driver="FileGDB", layer="poly_gadm", rows=slice(0, rows)
+    ).set_crs(4326)
+    gdf["location_id"] = gdf.index
+    benchmark(gdf[["location_id", "geometry"]])
+
+    return
+
+if __name__ == "__main__":
+    """This is executed when run from the command line"""
+
+    main(path_to_fgdb=cfg.fgdb_path)
+
+    print("done")
@@ -0,0 +1,55 @@
+import time
+import geopandas as gpd
+import wdpa_config as cfg
+from wdpa_create_list_table import serializeGeometry
+
+def payloadBytes(values, geometry_format):
+    """
+    Bytes sent to SQL Server for one batch of serialized geometry
+
+    Params:
+        values: Serialized geometries
+        geometry_format: "wkt" (sent as UTF-16 NVARCHAR) or "wkb" (VARBINARY)
+
+    Return:
+        Total payload size in bytes
+    """
+    if geometry_format == "wkt":
+        return sum(2 * len(v) for v in values)
+
+    return sum(len(v) for v in values)
+
+def main(path, batches=20, batch_size=1000):
+    """
+    Compares client CPU time and payload size of WKT and WKB geometry transfer
+
+    Params:
+        path: Path to the WDPA FGDB
+        batches: Number of batches to sample
+        batch_size: Rows per batch, as in the list table load
+    """
+    totals = {"wkt": [0.0, 0], "wkb": [0.0, 0]}
+
+    for i in range(0, batches * batch_size, batch_size):
+        gdf = gpd.read_file(path, driver="FileGDB", layer=0, rows=slice(i, i + batch_size))
+
+        for geometry_format in totals:
+            start = time.process_time()
+            values, _, _ = serializeGeometry(gdf, geometry_format)
+            totals[geometry_format][0] += time.process_time() - start
+            totals[geometry_format][1] += payloadBytes(values, geometry_format)
+
+    for geometry_format, (cpu, size) in totals.items():
+        print(
+            f"{geometry_format}: {cpu / batches * 1000:.1f} ms CPU and "
+            f"{size / batches / 1024**2:.2f} MB per {batch_size} row batch"
+        )
+
+    return
+
+if __name__ == "__main__":
+    """This is executed when run from the command line"""
+
+    main(cfg.fgdb_path)
+
+    print("done")
@@ -0,0 +1,95 @@
+import hashlib
+import pandas as pd
+from pathlib import Path
+
+lookup_columns = ["wdpa_pid", "gfw_geostore_id"]
+
+def sourceKey(json_path):
+    """
+    Identifies a version of the geostore JSON by name, size and mtime
+
+    Params:
+        json_path: Path to the geostore JSON
+
+    Return:
+        Short hex digest, changes whenever the JSON is replaced
+    """
+    stat = Path(json_path).stat()
+    source = f"{Path(json_path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+def parseGeostoreJson(json_path):
+    """
+    Parses the geostore JSON into a wdpa_pid -> gfw_geostore_id frame
+
+    Params:
+        json_path: Path to the geostore JSON
+
+    Return:
+        Dataframe with lookup_columns
+    """
+    df = pd.read_json(json_path)
+    df_expanded = pd.json_normalize(df["data"])
+
+    return df_expanded[lookup_columns]
+
+def loadGeostoreLookup(json_path, cache_dir=None):
+    """
+    Loads the geostore lookup, parsing the JSON only when it changed
+
+    The parsed lookup is kept as a Parquet file named after sourceKey, so
+    later runs against the same JSON read two columns instead of parsing
+    the whole file. Without pyarrow the JSON is parsed every run.
+
+    Params:
+        json_path: Path to the geostore JSON
+        cache_dir: Directory for the Parquet cache, None to disable it
+
+    Return:
+        Dataframe of gfw_geostore_id indexed by wdpa_pid (unique, str)
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = Path(cache_dir) / f"geostore_lookup_{sourceKey(json_path)}.parquet"
+
+    df = None
+    if cache_path is not None and cache_path.exists():
+        try:
+            df = pd.read_parquet(cache_path)
+            print(f"Loaded geostore lookup from {cache_path}")
+        except ImportError:
+            pass
+
+    if df is None:
+        df = parseGeostoreJson(json_path)
+        df["wdpa_pid"] = df["wdpa_pid"].astype(str)
+        # the first id wins, a duplicate pid would otherwise duplicate locations
+        df = df.drop_duplicates("wdpa_pid").reset_index(drop=True)
+
+        if cache_path is not None:
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                df.to_parquet(cache_path, index=False)
+                print(f"Cached geostore lookup to {cache_path}")
+            except ImportError:
+                pass
+
+    return df.set_index("wdpa_pid")
+
+def joinGeostore(gdf, lookup):
+    """
+    Adds gfw_geostore_id to each location through the indexed lookup
+
+    Params:
+        gdf: Geodataframe with a WDPA_PID column
+        lookup: Output of loadGeostoreLookup
+
+    Return:
+        gdf with a wdpa_pid and gfw_geostore_id column, NaN where no id exists
+    """
+    gdf = gdf.copy()
+    gdf["wdpa_pid"] = gdf["WDPA_PID"].astype(str)
+    gdf["gfw_geostore_id"] = gdf["wdpa_pid"].map(lookup["gfw_geostore_id"])
+
+    return gdf
@@ -1,85 +1,166 @@
-import numpy as np
+import sys
+import pandas as pd
 import geopandas as gpd
-from shapely import wkb
 from pathlib import Path
 import wdpa_config as cfg
+import wdpa_change_detection as changes
 
-def createGrid(degrees=1.0):
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from common import dicing, fgdb
+from common.diced_output import DicedWriter
+from common.dice_cache import DiceCache
+
+def diceWindow(gdf, list_id, workers=1, max_vertices=None, max_area=None, cache=None):
     """
-    Create a Geopandas dataframe fishnet grid
+    Dices one window of the poly_gadm layer
 
     Params:
-        degrees: Size of grid
+        gdf: Geodataframe with a location_id column, or whose index is the
+            row number in the layer
+        list_id: 4 for WDPA
+        workers: Number of dicing processes
+        max_vertices: Vertex budget per piece, enables adaptive dicing
+        max_area: Area budget per piece in square degrees, enables adaptive dicing
+        cache: Optional DiceCache of previously diced geometries
 
     Return:
-        geodataframe with grid
+        Diced geodataframe, see dicing.dice
     """
-    ulx, uly, lrx, lry = -180, 90, 180, -90
-
-    # resolution 1 degree grid
-    xres = degrees
-    yres = -degrees
-
-    # half the resolution
-    dx = xres / 2
-    dy = yres / 2
-
-    # center coordinates
-    xx, yy = np.meshgrid(
-        np.arange(ulx + dx, lrx + dx, xres),
-        np.arange(uly + dy, lry + dy, yres),
+    gdf = gdf.set_crs(4326)
+    gdf["list_id"] = list_id
+    if "location_id" not in gdf.columns:
+        gdf["location_id"] = gdf.index
+    gdf = gdf[["list_id", "location_id", "geometry"]]
+
+    gdf_intersection = dicing.dice(
+        gdf,
+        degrees=1,
+        cache_dir=getattr(cfg, "grid_cache_dir", None),
+        workers=workers,
+        max_vertices=max_vertices,
+        max_area=max_area,
+        max_level=getattr(cfg, "dice_max_level", 6),
+        cache=cache,
     )
 
-    wkts = []
-    for x, y in zip(xx.ravel(), yy.ravel()):
-        poly_wkt = f"POLYGON (({x - dx} {y - dy}, {x + dx} {y - dy}, {x + dx} {y + dy}, {x - dx} {y + dy}, {x - dx} {y - dy}))"
-        wkts.append(poly_wkt)
-
-    s = gpd.GeoSeries.from_wkt(wkts)
-    df = gpd.GeoDataFrame(geometry=s, crs="EPSG:4326")
-    df["grid"] = df.index
-
-    return df
-
-def main(path_to_fgdb, list_id):
+    return gdf_intersection
+
+def main(
+    path_to_fgdb,
+    list_id,
+    workers=1,
+    window_size=None,
+    max_vertices=None,
+    max_area=None,
+    out_format="tsv",
+    previous_fingerprints=None,
+    cache_path=None,
+):
     """
     Loads data and calls helper functions. Saves output to .txt
 
     Params:
         path_to_fgdb: Path to FGDB with GADMID attached
         list_id: 4 for WDPA
+        workers: Number of dicing processes
+        window_size: Rows per window when streaming, None loads the whole layer
+        max_vertices: Vertex budget per piece, enables adaptive dicing
+        max_area: Area budget per piece in square degrees, enables adaptive dicing
+        out_format: "tsv" for hex wkb text, "parquet" for GeoParquet
+        previous_fingerprints: Fingerprint file of the previous release. When
+            given only new or changed locations are diced, and removed ones
+            are written to a deletion list
+        cache_path: Optional SQLite file caching diced pieces between runs
     """
-    # Load data
-    print(f"loading {path_to_fgdb}")
-    gdf = gpd.read_file(path_to_fgdb, driver="FileGDB", layer="poly_gadm").set_crs(4326)
-    print("loaded location_id dataframe")
+    suffix = "txt" if out_format == "tsv" else "parquet"
+    diced_out = str(Path(cfg.out_dir) / f"diced_out.{suffix}")
 
-    gdf["list_id"] = list_id
-    gdf["location_id"] = gdf.index
+    columns = ["list_id", "location_id"]
+    if max_vertices is not None or max_area is not None:
+        columns += ["cell_id", "level"]
+
+    if window_size:
+        # Stream the layer so memory is bounded by the window, not the dataset
+        windows = fgdb.read_windows(path_to_fgdb, "poly_gadm", window_size)
+    else:
+        print(f"loading {path_to_fgdb}")
+        windows = [gpd.read_file(path_to_fgdb, driver="FileGDB", layer="poly_gadm")]
+        print("loaded location_id dataframe")
 
     # # Not needed
     # undiced_out = str(Path(cfg.out_dir) / "undiced_out.txt")
     # print(f"saving to {undiced_out}")
     # gdf.to_csv(undiced_out, sep="\t", index=False)
 
-    print("creating in memory grid")
-    grid = createGrid(degrees=1)
-
-    print("intersection with grid")
-    gdf_intersection = gpd.overlay(
-        gdf, grid, how="intersection", keep_geom_type=True, make_valid=True
-    )
-
-    print("save geometry as wkb")
-    gdf_intersection["geom"] = gdf_intersection.geometry.apply(
-        wkb.dumps, hex=True
-    )  # add in wkb
-
-    diced_out = str(Path(cfg.out_dir) / "diced_out.txt")
-    print(f"saving to {diced_out}")
-    gdf_intersection[["list_id", "location_id", "geom"]].to_csv(
-        diced_out, sep="\t", index=False
-    )
+    previous = None
+    if previous_fingerprints:
+        print(f"loading previous fingerprints from {previous_fingerprints}")
+        previous = changes.loadFingerprints(previous_fingerprints)
+        # existing protected areas keep the location_id already in the DB
+        location_ids = changes.LocationIds(previous)
+
+    cache = None
+    if cache_path:
+        cache = DiceCache(
+            cache_path, max_bytes=getattr(cfg, "dice_cache_max_bytes", 2 * 1024**3)
+        )
+
+    current = []
+    with DicedWriter(diced_out, fmt=out_format) as writer:
+        for gdf in windows:
+            if previous is not None:
+                gdf["location_id"] = location_ids.assign(gdf["WDPA_PID"])
+            else:
+                gdf["location_id"] = gdf.index
+            fingerprints = changes.fingerprint(gdf)
+            current.append(
+                pd.DataFrame(
+                    {
+                        "WDPA_PID": gdf["WDPA_PID"].astype(str),
+                        "location_id": gdf["location_id"].to_numpy(),
+                        "fingerprint": fingerprints,
+                    }
+                )
+            )
+
+            if previous is not None:
+                changed = changes.changedRows(gdf, fingerprints, previous)
+                print(f"{changed.sum()} of {len(gdf)} locations new or changed")
+                gdf = gdf[changed]
+
+            print(f"dicing {len(gdf)} locations")
+            diced = diceWindow(
+                gdf,
+                list_id,
+                workers=workers,
+                max_vertices=max_vertices,
+                max_area=max_area,
+                cache=cache,
+            )
+            del gdf
+
+            print(f"saving {len(diced)} pieces to {diced_out}")
+            writer.write(diced, columns)
+
+    print(f"saved {writer.rows} pieces")
+
+    if cache is not None:
+        cache.report()
+        cache.close()
+
+    current = pd.concat(current, ignore_index=True)
+    fingerprints_out = str(Path(cfg.out_dir) / "wdpa_fingerprints.txt")
+    print(f"saving fingerprints to {fingerprints_out}")
+    changes.saveFingerprints(fingerprints_out, current)
+    location_ids_out = str(Path(cfg.out_dir) / "wdpa_location_ids.txt")
+    print(f"saving location_ids to {location_ids_out}")
+    changes.saveLocationIds(location_ids_out, current)
+
+    if previous is not None:
+        deleted = changes.deletedLocations(current, previous)
+        deleted_out = str(Path(cfg.out_dir) / "deleted_locations.txt")
+        print(f"saving {len(deleted)} deleted locations to {deleted_out}")
+        deleted.to_csv(deleted_out, sep="\t", index=False)
 
     return
 
@@ -87,7 +168,14 @@ if __name__ == "__main__":
     """This is executed when run from the command line"""
 
     main(path_to_fgdb = cfg.fgdb_path,
-         list_id = 4
+         list_id = 4,
+         workers = getattr(cfg, "dice_workers", 1),
+         window_size = getattr(cfg, "dice_window_size", None),
+         max_vertices = getattr(cfg, "dice_max_vertices", None),
+         max_area = getattr(cfg, "dice_max_area", None),
+         out_format = getattr(cfg, "diced_format", "tsv"),
+         previous_fingerprints = getattr(cfg, "previous_fingerprints", None),
+         cache_path = getattr(cfg, "dice_cache_path", None)
          )
 
     print("done")